@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+class AdjacencyStore:
+    """Directory of city adjacencies in the simulator's graph format: one
+    subdirectory per adjacency, named by the hash of its content, with the CSR
+    arrays (indptr.npy, indices.npy) and, for integer node ids, the dense index
+    -> node id array (keys.npy). Every process opens them read-only
+    memory-mapped, so the OS page cache holds one physical copy of each
+    adjacency however many workers and replicas use it."""
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name, array):
+        return os.path.join(self.directory, name, array + ".npy")
+
+    def put(self, keys, indptr, indices):
+        """Store an adjacency if it is not stored yet, and return its memory-mapped
+        (keys, indptr, indices), with keys None for node ids that are not integers"""
+        keys = np.asarray(keys)
+        arrays = {"indptr": np.asarray(indptr, dtype=np.int64), "indices": np.asarray(indices, dtype=np.int64)}
+        if keys.dtype.kind in "iu":
+            arrays["keys"] = keys.astype(np.int64)
+        digest = hashlib.sha256()
+        for name in sorted(arrays):
+            digest.update(name.encode())
+            digest.update(arrays[name].tobytes())
+        name = digest.hexdigest()
+        if not os.path.exists(os.path.join(self.directory, name)):
+            write_entry(self.directory, name, arrays)
+        return self.load(name)
+
+    def load(self, name):
+        """Memory-mapped (keys, indptr, indices) of a stored adjacency"""
+        keys = self.path(name, "keys")
+        return (np.load(keys, mmap_mode='r') if os.path.exists(keys) else None,
+                np.load(self.path(name, "indptr"), mmap_mode='r'),
+                np.load(self.path(name, "indices"), mmap_mode='r'))
+
+def write_entry(directory, name, arrays, meta=None, replace=False):
+    # writes the arrays as .npy files (and meta as meta.json) of the
+    # subdirectory name of directory, first to a temporary directory that is
+    # then moved into place, so readers never see a partial entry. An entry
+    # stored meanwhile by another process is kept, unless replace
+    temporary = tempfile.mkdtemp(dir=directory)
+    for array, values in arrays.items():
+        np.save(os.path.join(temporary, array + ".npy"), values)
+    if meta is not None:
+        with open(os.path.join(temporary, "meta.json"), "w") as file:
+            json.dump(meta, file)
+    if replace:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    try:
+        os.rename(temporary, os.path.join(directory, name))
+    except OSError: # stored meanwhile by another process
+        shutil.rmtree(temporary)
+
+class MappedArray:
+    """Pickled form of a whole memory-mapped .npy file: only its path"""
+    def __init__(self, filename):
+        self.filename = filename
+
+def share_array(array):
+    # what to pickle for an array: the path of the .npy file it maps
+    # read-only as a whole, so the receiving process maps the same pages, or
+    # the array itself
+    if (isinstance(array, np.memmap) and array.mode == 'r' and array.filename is not None
+            and os.path.getsize(array.filename) == array.offset + array.nbytes):
+        return MappedArray(array.filename)
+    return array
+
+def open_array(value):
+    # array of a value made by share_array
+    if isinstance(value, MappedArray):
+        return np.load(value.filename, mmap_mode='r')
+    return value
@@ -0,0 +1,187 @@
+import copy
+import numpy as np
+from Compartments import SUSCEPTIBLE, NO_TRANSITION
+from RandomStreams import TRANSMISSION, PROGRESSION, name_key
+from NumbaKernels import kernel, contact_offsets
+
+class ArrayEngine:
+    """Vectorized step kernel for a City, driven by its compiled compartment
+    model over the dense node arrays and contact layers of the city"""
+    def __init__(self, city, jit=False, parallel=False):
+        self.city = city
+        self.state = city.state
+        self.transmit = kernel(parallel) if jit else None # Numba neighbor loop, None without Numba
+        self.hit = np.zeros(len(self.state), dtype=bool) # nodes reached by a transmission in the kernel
+        self.load_state()
+
+    @property
+    def rng(self):
+        # the city switches to the stream of the new day at the end of every step
+        return self.city.rng
+
+    def load_state(self):
+        """Take over the transition calendar of the city"""
+        self.calendar = {}
+        for day, nodes in self.city.transitions.items():
+            self.schedule(np.array(nodes, dtype=np.int64), day)
+        # live index array of the infectious nodes, so a day only touches the epidemic frontier
+        self.infected = np.flatnonzero(self.city.model.infectiousness[self.state] > 0)
+
+    def fork(self, city):
+        """Engine of a fork of the city. The node arrays queued in the calendar and
+        the infected array are never written in place, so the fork shares them"""
+        engine = copy.copy(self)
+        engine.city = city
+        engine.state = city.state
+        engine.calendar = {day: list(nodes) for day, nodes in self.calendar.items()}
+        engine.hit = np.zeros(len(city.state), dtype=bool)
+        return engine
+
+    def schedule(self, nodes, day):
+        """Queue an array of nodes to leave their current state on the given day"""
+        self.city.transition_day[nodes] = day
+        if day in self.calendar:
+            self.calendar[day].append(nodes)
+        else:
+            self.calendar[day] = [nodes]
+
+    def step(self, multiplier, contact_rate, onset_low, onset_high):
+        """Advance the city by one day, with the parameters of City.step"""
+        day = self.city.day
+        model = self.city.model
+
+        # infection of susceptible neighbors of every infectious node
+        layers = self.city.active_layers(contact_rate)
+        if self.transmit is not None or self.city.streams.common:
+            targets = self.transmitted(layers, multiplier)
+        else:
+            targets, pressure = self.infection_pressure(layers, multiplier)
+            targets = targets[self.rng.random(len(targets)) < pressure]
+        self.expose(targets, day + model.dwell[model.infection])
+
+        # only the nodes whose transition falls on today are progressed
+        due = self.calendar.pop(day, [])
+        due = np.concatenate(due) if due else np.empty(0, dtype=np.int64)
+        if len(due):
+            self.progress(due, model, day, onset_low, onset_high)
+        self.city.end_day()
+
+    def progress(self, due, model, day, onset_low, onset_high):
+        """Move the nodes due today to the next compartment drawn from the model"""
+        source = self.state[due]
+        destination = model.next_compartments(source, self.draws(due, 0))
+        self.state[due] = destination
+        self.city.record_moves(source, destination)
+
+        # nodes back in the susceptible compartment can be infected again
+        self.city.susceptibles.add_many(due[destination == SUSCEPTIBLE])
+
+        # nodes entering a compartment they leave on their own are queued again
+        self.city.transition_day[due] = NO_TRANSITION
+        timed = model.dwell[destination] > 0
+        nodes = due[timed]
+        days = day + model.dwell_times(destination[timed], onset_low, onset_high, self.draws(nodes, 1))
+        for transition_day in np.unique(days):
+            self.schedule(nodes[days == transition_day], int(transition_day))
+
+        was_infectious = model.infectiousness[source] > 0
+        infectious = model.infectiousness[destination] > 0
+        if (was_infectious & ~infectious).any():
+            self.infected = self.infected[model.infectiousness[self.state[self.infected]] > 0]
+        self.infected = np.concatenate((self.infected, due[infectious & ~was_infectious]))
+
+    def infection_pressure(self, layers, multiplier):
+        """Susceptible contacts of the infected nodes over all (layer, probability)
+        pairs, with the probability that at least one of their contacts transmits to them"""
+        infectiousness = self.city.model.infectiousness[self.state[self.infected]]
+        neighbors = []
+        probabilities = []
+        for layer, probability in layers:
+            counts = layer.indptr[self.infected + 1] - layer.indptr[self.infected]
+            neighbors.append(gather_neighbors(layer.indptr, layer.indices, self.infected))
+            probabilities.append(np.repeat(np.minimum(1.0, probability * multiplier * infectiousness), counts))
+        neighbors = np.concatenate(neighbors)
+        probabilities = np.concatenate(probabilities)
+        susceptible = self.state[neighbors] == SUSCEPTIBLE
+        targets, contacts = np.unique(neighbors[susceptible], return_inverse=True)
+        with np.errstate(divide='ignore'):
+            escape = np.bincount(contacts, weights=np.log1p(-probabilities[susceptible]), minlength=len(targets))
+        return targets, 1.0 - np.exp(escape)
+
+    def transmitted(self, layers, multiplier):
+        """Susceptible contacts of the infectious nodes reached by a transmission drawn per contact"""
+        infectiousness = self.city.model.infectiousness[self.state[self.infected]]
+        # active_layers follows the order of city.layers, whose names key the draws
+        for name, (layer, probability) in zip(self.city.layers, layers):
+            probabilities = np.minimum(1.0, probability * multiplier * infectiousness)
+            counts, offsets = contact_offsets(layer.indptr, self.infected)
+            if self.city.streams.common or self.transmit is None:
+                neighbors = gather_neighbors(layer.indptr, layer.indices, self.infected)
+            if self.city.streams.common: # keyed by layer name, source and neighbor
+                keys = np.repeat(self.infected, counts) * len(self.state) + neighbors
+                draws = self.city.streams.uniforms(TRANSMISSION, self.city.stream_index, self.city.day, keys, name_key(name))
+            else:
+                draws = self.rng.random(counts.sum())
+            if self.transmit is not None:
+                self.transmit(layer.indptr, layer.indices, self.infected, probabilities, offsets,
+                              draws, self.state, SUSCEPTIBLE, self.hit)
+            else:
+                reached = (self.state[neighbors] == SUSCEPTIBLE) & (draws < np.repeat(probabilities, counts))
+                self.hit[neighbors[reached]] = True
+        targets = np.flatnonzero(self.hit)
+        self.hit[targets] = False
+        return targets
+
+    def draws(self, nodes, salt):
+        """One uniform draw per node, keyed by the node with common random numbers"""
+        if self.city.streams.common:
+            return self.city.streams.uniforms(PROGRESSION, self.city.stream_index, self.city.day, nodes, salt)
+        return self.rng.random(len(nodes))
+
+    def expose(self, nodes, day):
+        """Move an array of distinct susceptible nodes to the infection compartment
+        until the given day, or for a dwell time drawn per node from its distribution"""
+        model = self.city.model
+        self.state[nodes] = model.infection
+        self.city.susceptibles.remove_many(nodes)
+        if model.sampled[model.infection]:
+            codes = np.full(len(nodes), model.infection, dtype=np.uint8)
+            days = day - model.dwell[model.infection] + model.dwell_times(codes, 0, 0, self.draws(nodes, 2))
+            for transition_day in np.unique(days):
+                self.schedule(nodes[days == transition_day], int(transition_day))
+        else:
+            self.schedule(nodes, day)
+        self.city.number_exposed += len(nodes)
+        if model.infectiousness[model.infection] > 0:
+            self.city.number_infected += len(nodes)
+            self.infected = np.concatenate((self.infected, nodes))
+
+def build_csr(network, keys, index):
+    # builds the indptr and indices arrays of the adjacency of a network,
+    # with nodes numbered by their position in keys
+    indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+    indices = []
+    for i, node in enumerate(keys):
+        neighbors = [index[neighbor] for neighbor in network.neighbors(node)]
+        indices.extend(neighbors)
+        indptr[i + 1] = indptr[i] + len(neighbors)
+    return indptr, np.array(indices, dtype=np.int64)
+
+def edges_to_csr(size, sources, targets):
+    # builds the indptr and indices arrays of the undirected adjacency of
+    # size nodes from the arrays of the two endpoints of every edge
+    rows = np.concatenate((sources, targets))
+    columns = np.concatenate((targets, sources))
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+    return indptr, columns[np.argsort(rows, kind='stable')]
+
+def gather_neighbors(indptr, indices, nodes):
+    # concatenates the neighbor lists of the given nodes into one array
+    return indices[gather_entries(indptr, nodes)]
+
+def gather_entries(indptr, nodes):
+    # positions in the indices array of the contacts of the given nodes, in order
+    starts = indptr[nodes]
+    counts = indptr[nodes + 1] - starts
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
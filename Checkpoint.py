@@ -0,0 +1,94 @@
+import glob
+import json
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Binary checkpoints of an OutbreakNetwork. A checkpoint is a NumPy .npz
+# archive holding the arrays of OutbreakNetwork.checkpoint (compartment
+# arrays, susceptible pools, calendars and contact layers of every city) and
+# its metadata (day counter, case history, random stream and generator states)
+# as a JSON array under the "meta" key, tagged with FORMAT_VERSION.
+
+FORMAT_VERSION = 1
+
+def write_checkpoint(path, meta, arrays):
+    # writes a checkpoint next to path and moves it into place, so a crash
+    # during the write never leaves a truncated checkpoint behind
+    meta = dict(meta, version=FORMAT_VERSION)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        np.savez_compressed(file, meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8), **arrays)
+    os.replace(temporary, path)
+
+def read_checkpoint(path):
+    # reads the (metadata, arrays) of a checkpoint written by write_checkpoint
+    with np.load(path) as archive:
+        meta = json.loads(archive["meta"].tobytes().decode())
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError("Unsupported checkpoint version " + str(meta.get("version")) + " in " + path)
+        arrays = {name: archive[name] for name in archive.files if name != "meta"}
+    return meta, arrays
+
+class Checkpointer:
+    """Saves a checkpoint of an OutbreakNetwork to a directory every few days
+    and resumes from the latest one. The state is copied on the step loop,
+    which is cheap, and compressed and written on a background thread, so the
+    simulation keeps stepping during the write. Only the latest keep
+    checkpoints are kept."""
+    def __init__(self, directory, every=10, keep=2):
+        self.directory = directory
+        self.every = every
+        self.keep = keep
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, day):
+        """Checkpoint file of a day"""
+        return os.path.join(self.directory, "checkpoint-%06d.npz" % day)
+
+    def checkpoints(self):
+        """Checkpoint files of the directory, oldest first"""
+        return sorted(glob.glob(os.path.join(self.directory, "checkpoint-*.npz")))
+
+    def save(self, network, force=False):
+        """Checkpoint the network if its day is a multiple of every (or force) without waiting for the write"""
+        if not force and network.day % self.every != 0:
+            return
+        meta, arrays = network.checkpoint()
+        for future in self.pending:
+            if future.done():
+                future.result() # raises the error of a failed write
+        self.pending = [future for future in self.pending if not future.done()]
+        self.pending.append(self.writer.submit(self.write, self.path(network.day), meta, arrays))
+
+    def write(self, path, meta, arrays):
+        # runs on the writer thread
+        write_checkpoint(path, meta, arrays)
+        for old in self.checkpoints()[:-self.keep]:
+            os.remove(old)
+
+    def wait(self):
+        """Wait for the pending writes, raising the error of a failed one"""
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def latest(self):
+        """Path of the latest checkpoint, or None"""
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def resume(self, network):
+        """Restore the network from the latest checkpoint, and return whether there was one"""
+        path = self.latest()
+        if path is None:
+            return False
+        network.restore(*read_checkpoint(path))
+        return True
+
+    def close(self):
+        """Finish the pending writes and stop the writer thread"""
+        self.wait()
+        self.writer.shutdown()
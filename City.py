@@ -1,135 +1,511 @@
-import networkx as nx
-import random
+import copy
+import zlib
+import numpy as np
 import osmnx as ox
+from collections.abc import Mapping
+from ArrayEngine import ArrayEngine, build_csr, edges_to_csr
+from SusceptiblePool import SusceptiblePool
+from Sampling import select_random, select_from, random_pairing
+from ContactLayer import ContactLayer
+from Rewiring import rewire_graph
+from StreetNetworks import StreetGraph
+from AdjacencyStore import share_array, open_array
+from RandomStreams import RandomStreams, GRAPH, SETUP, IMPORTS, generator_state, restore_generator
+from Compartments import SUSCEPTIBLE, EXPOSED, INFECTED, REMOVED, STATE_NAMES, NO_TRANSITION, SEIR_MODEL
 
 BETA = .5 # Infection probability
 SIGMA = 3 # Number of days someone stays in Exposed state
 MU = 15 # Number of days someone stays in Infected State
+MOBILITY_CONTACTS = 2 # Number of people outside the household a mobile person meets each day
+
+# Parameters of a day of the SEIR model (transmission multiplier, fraction of contacts
+# kept, range of the random change to MU) without and with social distancing
+SEIR_PARAMETERS = (1.0, 1.0, -1, 7)
+SD_SEIR_PARAMETERS = (0.25, 0.20, -2, 6)
 
 # Possible states that a node could be in
-SUSCEPTIBLE_STATE = "Susceptible"
-EXPOSED_STATE = "Exposed"
-INFECTED_STATE = "Infected"
-REMOVED_STATE = "Removed"
+SUSCEPTIBLE_STATE = STATE_NAMES[SUSCEPTIBLE]
+EXPOSED_STATE = STATE_NAMES[EXPOSED]
+INFECTED_STATE = STATE_NAMES[INFECTED]
+REMOVED_STATE = STATE_NAMES[REMOVED]
+
+# Engines that can step a city: the loop over the active nodes in City, which
+# only runs the SEIR model, or the vectorized NumPy engine in ArrayEngine.py,
+# which runs any compartment model, optionally with its neighbor loop compiled
+# by Numba (on one core or split across all of them)
+PYTHON_ENGINE = "python"
+NUMPY_ENGINE = "numpy"
+NUMBA_ENGINE = "numba"
+PARALLEL_ENGINE = "numba-parallel"
+ENGINES = (PYTHON_ENGINE, NUMPY_ENGINE, NUMBA_ENGINE, PARALLEL_ENGINE)
 
 class City:
-    def __init__(self, location, number_initial_infections, network, density):
+    def __init__(self, location, number_initial_infections, network, density, engine=PYTHON_ENGINE,
+                 model=SEIR_MODEL, streams=None, index=0, graph_cache=None):
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine " + repr(engine) + ", expected one of " + ", ".join(ENGINES))
+        if model is not SEIR_MODEL and engine == PYTHON_ENGINE:
+            raise ValueError("Only the SEIR model can run on the python engine")
+        if streams is not None and streams.common and engine == PYTHON_ENGINE:
+            raise ValueError("Common random numbers need an array engine")
         self.city_name = location
         self.network = network
         self.density = density
         self.beta = BETA
         self.sigma = SIGMA
         self.mu = MU
+        self.model = model.compile(self) # compartment tables read by the step kernel
+        # every draw comes from the stream of this city (its position in the
+        # OutbreakNetwork) for the current day, so runs sharing streams are reproducible
+        self.streams = streams if streams is not None else RandomStreams()
+        self.stream_index = index
+        self.graph_cache = graph_cache # GraphCache of the rewired graphs, or None
         self.number_infected = 0
         self.number_exposed = 0
         self.number_removed = 0
         self.init_graph()
-        self.network_keys = list(self.network.nodes())
+        self.network_keys = list(self.network.nodes()) # dense index -> network (OSM) node id
+        self.index_map = {node: i for i, node in enumerate(self.network_keys)} # network node id -> dense index
+        self.shared = False # whether the adjacency lives in an AdjacencyStore
+        self.layers = {} # named contact layers, each with its own CSR adjacency and transmission
+        self.layer_scales = {} # mitigation scale of every layer, kept across daily layers
+        self.thinned_layers = {} # social distancing view of every layer for the current policy period
+        self.build_adjacency()
+        self.state = np.full(len(self.network_keys), SUSCEPTIBLE, dtype=np.uint8) # compartment code of every node
+        self.transition_day = np.full(len(self.network_keys), NO_TRANSITION, dtype=np.int16) # day every node leaves its compartment
+        self.states = NodeView(self, self.state_name) # read-only node -> state name view
+        self.durations = NodeView(self, self.remaining_duration) # read-only node -> days left view
+        self.susceptibles = SusceptiblePool(len(self.network_keys)) # nodes that can still be exposed
         self.init_infections = number_initial_infections
+        self.engine = None # the array engine takes over the initial infections once they are placed
         self.init_infection(self.init_infections)
+        if engine != PYTHON_ENGINE:
+            self.engine = ArrayEngine(self, jit=engine in (NUMBA_ENGINE, PARALLEL_ENGINE), parallel=engine == PARALLEL_ENGINE)
+            self.exposed_nodes = self.infected_nodes = None
         self.color_map = []
 
+    @property
+    def node_index(self):
+        """Mapping from network node id to dense index, rebuilt on first use in worker processes"""
+        if self.index_map is None:
+            self.index_map = {node: i for i, node in enumerate(self.network_keys)}
+        return self.index_map
+
+    def share_adjacency(self, store):
+        """Move the street adjacency and node ids of the city to an AdjacencyStore and map them from there"""
+        # a shared city is pickled without its networkx graph and with the paths of its adjacency files
+        keys, self.indptr, self.indices = store.put(self.network_keys, self.indptr, self.indices)
+        if keys is not None:
+            self.network_keys = keys
+        street = self.layers["street"]
+        street.indptr, street.indices = self.indptr, self.indices
+        self.shared = True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared:
+            state["network"] = None
+            state["index_map"] = None
+        for name in ("network_keys", "indptr", "indices"):
+            state[name] = share_array(state[name])
+        return state
+
+    def __setstate__(self, state):
+        for name in ("network_keys", "indptr", "indices"):
+            state[name] = open_array(state[name])
+        self.__dict__.update(state)
+
+    def fork(self):
+        """Copy of the city at the current day that can be stepped on its own"""
+        # the graph, index maps, model and adjacency arrays are never written once built, so they are shared
+        city = City.__new__(City) # not copy.copy, which would pickle a shared city without its graph
+        city.__dict__.update(self.__dict__)
+        city.state = self.state.copy()
+        city.transition_day = self.transition_day.copy()
+        city.states = NodeView(city, city.state_name)
+        city.durations = NodeView(city, city.remaining_duration)
+        city.susceptibles = self.susceptibles.copy()
+        if self.engine is None:
+            city.exposed_nodes = set(self.exposed_nodes)
+            city.infected_nodes = set(self.infected_nodes)
+        city.transitions = {day: list(nodes) for day, nodes in self.transitions.items()}
+        # layer objects are copied so scaling one city's layer leaves the other alone
+        city.layers = {name: layer.copy() for name, layer in self.layers.items()}
+        city.layer_scales = dict(self.layer_scales)
+        city.thinned_layers = {name: (city.layers.get(name) if thinned[0] is self.layers.get(name) else thinned[0],) + thinned[1:]
+                               for name, thinned in self.thinned_layers.items()}
+        city.rng = copy.deepcopy(self.rng)
+        city.imports_stream = copy.deepcopy(self.imports_stream)
+        city.engine = self.engine.fork(city) if self.engine is not None else None
+        city.color_map = []
+        return city
+
+    def checkpoint(self):
+        """Simulation state of the city as (metadata, arrays) for a checkpoint. The
+        street layer is rebuilt from the graph on construction, so only its checksum is kept"""
+        calendar = self.engine.calendar if self.engine is not None else self.transitions
+        days = sorted(calendar)
+        queued = [np.concatenate(calendar[day]) if self.engine is not None else np.array(calendar[day], dtype=np.int64)
+                  for day in days]
+        arrays = {"state": self.state.copy(), "transition_day": self.transition_day.copy(),
+                  "pool_nodes": self.susceptibles.nodes.copy(), "pool_position": self.susceptibles.position.copy(),
+                  "calendar_days": np.array(days, dtype=np.int64),
+                  "calendar_sizes": np.array([len(nodes) for nodes in queued], dtype=np.int64),
+                  "calendar_nodes": np.concatenate(queued) if queued else np.empty(0, dtype=np.int64)}
+        if self.engine is not None:
+            arrays["infected"] = self.engine.infected.copy()
+        layers = {}
+        for name, layer in self.layers.items():
+            if name != "street":
+                layers[name] = {"transmission": layer.transmission, "scale": layer.scale, "daily": layer.daily}
+                arrays["layer." + name + ".indptr"] = layer.indptr
+                arrays["layer." + name + ".indices"] = layer.indices
+        thinned = {}
+        for name, (layer, rate, thin) in self.thinned_layers.items():
+            if layer is self.layers.get(name): # thinned views of replaced layers are never used again
+                thinned[name] = rate
+                arrays["thinned." + name + ".indptr"] = thin.indptr
+                arrays["thinned." + name + ".indices"] = thin.indices
+        meta = {"day": self.day, "pool_count": int(self.susceptibles.count),
+                "counters": [int(self.number_infected), int(self.number_exposed), int(self.number_removed)],
+                "street": zlib.crc32(self.indices.tobytes()), "layers": layers, "thinned": thinned,
+                "layer_scales": dict(self.layer_scales), "streams": self.streams.get_state(), "rng": generator_state(self.rng),
+                "imports": None if self.imports_stream[1] is None else
+                           [self.imports_stream[0], generator_state(self.imports_stream[1])]}
+        return meta, arrays
+
+    def restore(self, meta, arrays):
+        """Continue from the state made by checkpoint on a city built from the same graph"""
+        if len(arrays["state"]) != len(self.state) or meta["street"] != zlib.crc32(self.indices.tobytes()):
+            raise ValueError("The checkpoint of " + self.city_name + " was made on a different graph")
+        self.streams.set_state(meta["streams"])
+        self.state[:] = arrays["state"]
+        self.transition_day[:] = arrays["transition_day"]
+        self.susceptibles.nodes[:] = arrays["pool_nodes"]
+        self.susceptibles.position[:] = arrays["pool_position"]
+        self.susceptibles.count = meta["pool_count"]
+        self.day = meta["day"]
+        self.number_infected, self.number_exposed, self.number_removed = meta["counters"]
+        days = arrays["calendar_days"].tolist()
+        queued = np.split(arrays["calendar_nodes"], np.cumsum(arrays["calendar_sizes"])[:-1]) if days else []
+        if self.engine is None:
+            self.exposed_nodes = set(np.flatnonzero(self.state == EXPOSED).tolist())
+            self.infected_nodes = set(np.flatnonzero(self.state == INFECTED).tolist())
+        self.transitions = {} if self.engine is not None else {day: nodes.tolist() for day, nodes in zip(days, queued)}
+        if self.engine is not None:
+            self.engine.calendar = {day: [nodes] for day, nodes in zip(days, queued)}
+            self.engine.infected = arrays["infected"]
+        self.layers = {"street": self.layers["street"]}
+        for name, layer in meta["layers"].items():
+            self.layers[name] = ContactLayer(arrays["layer." + name + ".indptr"], arrays["layer." + name + ".indices"],
+                                             layer["transmission"], layer["daily"])
+            self.layers[name].scale = layer["scale"]
+        self.layer_scales = dict(meta["layer_scales"])
+        self.layers["street"].scale = self.layer_scales.get("street", 1.0)
+        self.thinned_layers = {}
+        for name, rate in meta["thinned"].items():
+            layer = self.layers[name]
+            thin = ContactLayer(arrays["thinned." + name + ".indptr"], arrays["thinned." + name + ".indices"],
+                                layer.transmission, layer.daily)
+            thin.scale = layer.scale
+            self.thinned_layers[name] = (layer, rate, thin)
+        self.rng = restore_generator(meta["rng"])
+        imports = meta["imports"]
+        self.imports_stream = (None, None) if imports is None else (imports[0], restore_generator(imports[1]))
+
     def init_graph(self):
-        """Improve the functionality of our graph """
+        """Improve the functionality of our graph, replaying a cached rewiring when there is one"""
         one_percent_of_nodes = self.network.number_of_nodes() * .01
         num_swaps = round(one_percent_of_nodes * (self.density/10))
-        self.network = nx.double_edge_swap(self.network, nswaps=num_swaps)
+        seed = int(self.streams.generator(GRAPH, self.stream_index).integers(2**31))
+        self.graph_key = None
+        if self.graph_cache is not None and self.streams.seeded: # unseeded rewirings are never drawn again
+            self.graph_key = self.graph_cache.key(self.network, self.density, num_swaps, seed)
+        if isinstance(self.network, StreetGraph):
+            # the edge arrays are rewired directly, or read back from the cached adjacency
+            adjacency = self.graph_cache.adjacency(self.graph_key) if self.graph_key is not None else None
+            if adjacency is not None:
+                self.network = StreetGraph.from_adjacency(self.network.keys, *adjacency)
+            else:
+                self.network = self.network.rewired(num_swaps, np.random.default_rng(seed))
+            self.rewiring = ([], [])
+            return
+        if self.graph_key is not None and self.graph_cache.replay(self.graph_key, self.network):
+            return
+        # batched double edge swaps over the edge arrays, see Rewiring.py
+        self.rewiring = rewire_graph(self.network, num_swaps, np.random.default_rng(seed)) # (removed, added) edges
+
+    def build_adjacency(self):
+        """Build the CSR adjacency (indptr, indices) of the network over the dense node indices,
+        which is the street layer of the city. A cached adjacency is memory-mapped instead"""
+        adjacency = self.graph_cache.adjacency(self.graph_key) if self.graph_key is not None else None
+        if adjacency is not None:
+            self.indptr, self.indices = adjacency
+        else:
+            if isinstance(self.network, StreetGraph):
+                self.indptr, self.indices = self.network.adjacency()
+            else:
+                self.indptr, self.indices = build_csr(self.network, self.network_keys, self.node_index)
+            if self.graph_key is not None:
+                self.graph_cache.store(self.graph_key, *self.rewiring, self.indptr, self.indices)
+        self.rewiring = None
+        self.set_layer("street", ContactLayer(self.indptr, self.indices, self.beta))
+
+    def set_layer(self, name, layer):
+        """Add (or replace) a named contact layer, applying the scale set for that name"""
+        layer.scale = self.layer_scales.get(name, 1.0)
+        self.layers[name] = layer
+
+    def add_layer(self, name, sources, targets, transmission, daily=False):
+        """Add (or replace) a named contact layer from the arrays of the dense endpoints of its contacts"""
+        indptr, indices = edges_to_csr(len(self.network_keys), sources, targets)
+        self.set_layer(name, ContactLayer(indptr, indices, transmission, daily))
+
+    def scale_layer(self, name, scale):
+        """Scale the transmission of a contact layer, e.g. to turn mobility down under lockdown.
+        The scale also applies to later daily layers of the same name"""
+        self.layer_scales[name] = scale
+        if name in self.layers:
+            self.layers[name].scale = scale
+
+    def active_layers(self, contact_rate):
+        """(layer, transmission probability) pairs to step with, in the order of layers"""
+        # below a contact rate of 1 the layers are thinned views keeping that fraction of the
+        # contacts, drawn once per policy period (and once per day for daily layers)
+        if contact_rate >= 1.0:
+            return [(layer, layer.probability()) for layer in self.layers.values()]
+        layers = []
+        for name, layer in self.layers.items():
+            thinned = self.thinned_layers.get(name)
+            if thinned is None or thinned[0] is not layer or thinned[1] != contact_rate:
+                thinned = (layer, contact_rate, layer.thin(contact_rate, self.rng))
+                self.thinned_layers[name] = thinned
+            layers.append((thinned[2], layer.probability()))
+        return layers
+
+    def new_policy_period(self):
+        """Forget the thinned layers, so the next distancing day draws new ones"""
+        self.thinned_layers = {}
+
+    def end_day(self):
+        """Drop the daily contact layers and advance the day"""
+        for name in [name for name, layer in self.layers.items() if layer.daily]:
+            del self.layers[name]
+        self.day += 1
+        self.rng = self.streams.city(self.stream_index, self.day)
+
+    def to_indices(self, nodes):
+        """Dense indices of the given network node ids"""
+        return [self.node_index[node] for node in nodes]
+
+    def to_nodes(self, indices):
+        """Network node ids of the given dense indices"""
+        return [self.network_keys[index] for index in indices]
 
     def init_infection(self, number_initial_infections):
         """Initially infect a certain number of nodes in a network"""
-        nx.set_node_attributes(self.network, SUSCEPTIBLE_STATE, 'state') #Everyone starts succeptible
-        nx.set_node_attributes(self.network, float('inf'), 'duration')
-        while (self.number_infected < number_initial_infections):
-            initial_infect_index = self.network_keys[random.randint(0, len(self.network_keys) - 1)] # get an initial sick node
-            self.network.nodes(data=True)[initial_infect_index]['state'] = INFECTED_STATE #infect that node
-            self.network.nodes(data=True)[initial_infect_index]['duration'] = self.mu
+        self.state[:] = SUSCEPTIBLE #Everyone starts succeptible
+        self.transition_day[:] = NO_TRANSITION
+        self.susceptibles.reset()
+        # the nodes in the Exposed and Infected states, which only the python engine
+        # steps from. The array engines keep them in the state array alone
+        self.exposed_nodes = set() if self.engine is None else None
+        self.infected_nodes = set() if self.engine is None else None
+        self.day = 0
+        self.transitions = {}
+        self.rng = self.streams.generator(SETUP, self.stream_index)
+        self.imports_stream = (None, None) # (day, generator) of the introductions
+        seeds = self.susceptibles.sample(number_initial_infections, self.rng) # distinct initial sick nodes
+        days = np.full(len(seeds), self.model.dwell[self.model.seed])
+        if self.model.sampled[self.model.seed]:
+            days = self.model.dwell_times(np.full(len(seeds), self.model.seed, dtype=np.uint8), 0, 0, self.rng.random(len(seeds)))
+        for initial_infect_index, dwell in zip(seeds.tolist(), days.tolist()):
+            self.state[initial_infect_index] = self.model.seed #infect that node
+            self.susceptibles.remove(initial_infect_index)
+            self.schedule_transition(initial_infect_index, dwell - 1)
+            if self.engine is None:
+                self.infected_nodes.add(initial_infect_index)
             self.number_infected += 1
+        self.rng = self.streams.city(self.stream_index, self.day)
             
-    def refresh_city(self):
-        """Clean slate"""
+    def refresh_city(self, run=None):
+        """Clean slate, drawn from the streams of the given run (by default the
+        run after the current one) so that repeated runs differ"""
+        self.streams = self.streams.for_run(self.streams.run + 1 if run is None else run)
+        for name in [name for name, layer in self.layers.items() if layer.daily]:
+            del self.layers[name]
+        self.layer_scales = {}
+        for layer in self.layers.values():
+            layer.scale = 1.0
+        self.thinned_layers = {}
         self.number_exposed = 0
         self.number_removed = 0
         self.number_infected = 0
-        for node_index in self.network_keys: # for every node
-            if self.network.nodes[node_index]['state'] != SUSCEPTIBLE_STATE:
-                self.network.nodes[node_index]['state'] = SUSCEPTIBLE_STATE
         self.init_infection(self.init_infections)
+        if self.engine is not None:
+            self.engine.load_state()
+
+    def schedule_transition(self, node_index, day):
+        """Queue a node to leave its current compartment on the given day"""
+        self.transition_day[node_index] = day
+        if day in self.transitions:
+            self.transitions[day].append(node_index)
+        else:
+            self.transitions[day] = [node_index]
+
+    def state_name(self, index):
+        """Name of the state of the node at the given index"""
+        return self.model.names[self.state[index]]
+
+    def remaining_duration(self, index):
+        """Number of steps until the node at the given index leaves its state"""
+        if self.transition_day[index] == NO_TRANSITION:
+            return float('inf')
+        return int(self.transition_day[index]) - self.day + 1
     
     def run_seir(self, number_of_steps):
         """ Method to run an SEIR Model on the city network for a given number of steps"""
-        #loop through infection process 
         for step in range(number_of_steps): #loop through the number of steps
             #print("Starting SEIR Time Step: ", step)
-            
-            for node_index in self.network_keys: # for every node
-                if self.network.nodes[node_index]['state'] == INFECTED_STATE: #If that node is infected
-                    self.network.nodes[node_index]['duration'] -= 1
-                    if (self.network.nodes[node_index]['duration']) == 0:
-                        self.network.nodes[node_index]['state'] = REMOVED_STATE
-                        self.number_removed += 1
-                        self.number_infected -= 1
-
-                    for neighbor in list(self.network.neighbors(node_index)): #Loop through all the neighbors of that node
-                        if(random.random() <= self.beta and self.network.nodes[neighbor]['state'] == SUSCEPTIBLE_STATE): # If some random number is greater than beta and the person is not immune then we will infect the neighbor
-                            self.network.nodes[neighbor]['state'] = EXPOSED_STATE #infect Neighbor
-                            self.network.nodes[neighbor]['duration'] = self.sigma
-                            self.number_exposed += 1
-                        
-                elif self.network.nodes[node_index]['state'] == EXPOSED_STATE:
-                     self.network.nodes[node_index]['duration'] -= 1
-                     if (self.network.nodes[node_index]['duration']) == 0:
-                        self.network.nodes[node_index]['state'] = INFECTED_STATE
-                        self.network.nodes[node_index]['duration'] = self.mu + random.randint(-1, 7)
-                        self.number_infected += 1
+            self.step(*SEIR_PARAMETERS)
 
     def run_sd_seir(self, number_of_steps, severity):
         """Method to run an SEIR Model on the city network for a given number of steps during mitigation sequences"""
-        #loop through infection process 
         for step in range(number_of_steps): #loop through the number of steps
             print("Starting SEIR Time Step: ", step)
-            
-            for node_index in self.network_keys: # for every node
-                if self.network.nodes[node_index]['state'] == INFECTED_STATE: #If that node is infected
-                    self.network.nodes[node_index]['duration'] -= 1
-                    if (self.network.nodes[node_index]['duration']) == 0:
-                        self.network.nodes[node_index]['state'] = REMOVED_STATE
-                        self.number_removed += 1
-                        self.number_infected -= 1
-
-                    sd_neighbors = list(self.network.neighbors(node_index))
-                    #sd_neighbors = self.select_random(severity, initial_neighbors)
-                    for neighbor in sd_neighbors: #Loop through all the neighbors of that node
-                        if random.random() > 0.80:
-                            if(random.random() <= self.beta/4 and self.network.nodes[neighbor]['state'] == SUSCEPTIBLE_STATE): # If some random number is greater than beta and the person is not immune then we will infect the neighbor
-                                self.network.nodes[neighbor]['state'] = EXPOSED_STATE #infect Neighbor
-                                self.network.nodes[neighbor]['duration'] = self.sigma
-                                self.number_exposed += 1
-                elif self.network.nodes[node_index]['state'] == EXPOSED_STATE:
-                     self.network.nodes[node_index]['duration'] -= 1
-                     if (self.network.nodes[node_index]['duration']) == 0:
-                        self.network.nodes[node_index]['state'] = INFECTED_STATE
-                        self.network.nodes[node_index]['duration'] = self.mu + random.randint(-2, 6)
-                        self.number_infected += 1
+            self.step(*SD_SEIR_PARAMETERS)
+
+    def step(self, multiplier, contact_rate, onset_low, onset_high):
+        """Method to run one day of the SEIR Model"""
+        if self.engine is not None:
+            self.engine.step(multiplier, contact_rate, onset_low, onset_high)
+            return
+        #loop through infection process 
+        layers = self.active_layers(contact_rate)
+        for node_index in sorted(self.infected_nodes): # only the infected nodes are visited, in an order that does not depend on the set history
+            for layer, probability in layers:
+                probability *= multiplier
+                neighbors = layer.neighbors(node_index)
+                draws = self.rng.random(len(neighbors)).tolist()
+                for neighbor, draw in zip(neighbors, draws): #Loop through all the neighbors of that node
+                    if(draw <= probability and self.state[neighbor] == SUSCEPTIBLE): # If some random number is greater than beta and the person is not immune then we will infect the neighbor
+                        self.expose(neighbor, self.day + self.sigma) #infect Neighbor
+        self.progress_transitions(onset_low, onset_high)
+
+    def run_day(self, parameters, mobility_scale=None, new_period=False):
+        """Method to run one day of the SEIR Model with the step parameters, mobility layer
+        scale and policy period flag of a compiled policy"""
+        if new_period:
+            self.new_policy_period()
+        if mobility_scale is not None:
+            self.scale_layer("mobility", mobility_scale)
+        self.step(*parameters)
+
+    def progress_transitions(self, onset_low, onset_high):
+        """Move the nodes whose transition falls on the current day to their next state, and advance the day"""
+        for node_index in self.transitions.pop(self.day, []):
+            if self.state[node_index] == INFECTED:
+                self.state[node_index] = REMOVED
+                self.transition_day[node_index] = NO_TRANSITION
+                self.infected_nodes.discard(node_index)
+                self.number_removed += 1
+                self.number_infected -= 1
+            elif self.state[node_index] == EXPOSED:
+                self.state[node_index] = INFECTED
+                self.schedule_transition(node_index, self.day + self.mu + int(self.rng.integers(onset_low, onset_high + 1)))
+                self.exposed_nodes.discard(node_index)
+                self.infected_nodes.add(node_index)
+                self.number_infected += 1
+        self.end_day()
+
+    def record_moves(self, source, destination):
+        """Update the counters for nodes moving from the source to the destination compartment codes"""
+        infectious = self.model.infectiousness
+        removed = self.model.removed
+        self.number_infected += int(np.count_nonzero(infectious[destination] > 0) - np.count_nonzero(infectious[source] > 0))
+        self.number_removed += int(np.count_nonzero(removed[destination] & ~removed[source]))
 
     def select_random(self, severity, neighbors):
-        included = []
-        length = int(len(neighbors)/(severity/1.5))
-        for i in range(length):
-            num = random.randint(0, len(neighbors) - 1)
-            node = neighbors[num]
-            if node in included:
-                numbers = range(0,num) + range(num + 1, len(neighbors))
-                node = neighbors[random.choice(numbers)]
-                included.append(node)
-        return list(set(included))
+        """Method to select a random subset of about len(neighbors)/(severity/1.5) distinct neighbors"""
+        return select_from(neighbors, len(neighbors)/(severity/1.5), self.rng).tolist()
+
+    def simulate_mobility(self, mitigation, mitigation_severity):
+        """Method to sample the day's random connections between people who do not live together"""
+        # kept as the daily "mobility" layer, which the next step uses and then discards
+        size = len(self.network_keys)
+        selection = select_random(size/self.density, size, self.rng)
+        selection_two = select_random(size/(self.density/2), size, self.rng)
+        sources, targets = random_pairing(selection, selection_two, MOBILITY_CONTACTS, self.rng)
+        if mitigation != 0: # each contact only happens with probability 1/(severity + 2)
+            kept = self.rng.integers(0, mitigation_severity + 2, size=len(sources)) == mitigation_severity
+            sources, targets = sources[kept], targets[kept]
+        self.add_layer("mobility", sources, targets, self.beta, daily=True)
 
     def introduce_infected_node(self):
-        """Method to infect a random node"""
-        infect_index = random.randint(0, len(self.network_keys) - 1)
-        infect_index = self.network_keys[infect_index]
-        while (self.network.nodes[infect_index]['state'] != SUSCEPTIBLE_STATE):
-            infect_index = self.network_keys[random.randint(0, len(self.network_keys) - 1)]
-        self.network.nodes[infect_index]['state'] = EXPOSED_STATE #infect that node
-        self.network.nodes[infect_index]['duration'] = self.sigma
+        """Method to infect a random susceptible node, if any is left"""
+        infect_index = self.susceptibles.choice(self.imports_rng())
+        if infect_index is None:
+            return
+        if self.engine is not None:
+            self.engine.expose(np.array([infect_index]), self.exposure_day())
+        else:
+            self.expose(infect_index, self.exposure_day())
 
+    def introduce_infected_nodes(self, count):
+        """Method to infect count distinct random susceptible nodes at once, or
+        every susceptible node left if there are fewer than count"""
+        self.introduce(self.susceptibles.sample(count, self.imports_rng()))
+
+    def imports_rng(self):
+        """Generator of the introductions into the city on the current day, apart from
+        the day stream so that the draws of the step do not depend on the imports"""
+        if self.imports_stream[0] != self.day:
+            self.imports_stream = (self.day, self.streams.generator(IMPORTS, self.stream_index, self.day))
+        return self.imports_stream[1]
+
+    def seed_nodes(self, nodes):
+        """Method to expose specific nodes, given by their network node ids, each once
+        however often it is given"""
+        node_indices = np.unique(np.asarray(self.to_indices(nodes), dtype=np.int64))
+        self.introduce(node_indices[self.state[node_indices] == SUSCEPTIBLE])
+
+    def introduce(self, node_indices):
+        """Expose an array of distinct susceptible nodes between two steps"""
+        if self.engine is not None:
+            self.engine.expose(node_indices, self.exposure_day())
+        else:
+            for node_index in node_indices.tolist():
+                self.expose(node_index, self.exposure_day())
+
+    def exposure_day(self):
+        """Day on which a node exposed between two steps leaves the infection compartment"""
+        return self.day + int(self.model.dwell[self.model.infection]) - 1
+
+    def expose(self, node_index, day):
+        """Move a susceptible node to the Exposed state until the given day"""
+        self.state[node_index] = EXPOSED #infect that node
+        self.susceptibles.remove(node_index)
+        self.schedule_transition(node_index, day)
+        self.exposed_nodes.add(node_index)
         self.number_exposed += 1
+
+    def node_colors(self, colors):
+        """Color of every node in network order for plotting, given a state name -> color dict"""
+        self.color_map = [colors[self.model.names[code]] for code in self.state]
+        return self.color_map
+
+class NodeView(Mapping):
+    """Read-only mapping from the nodes of a city to a value looked up from its state arrays,
+    so callers can keep addressing nodes by their network keys"""
+    def __init__(self, city, lookup):
+        self.city = city
+        self.lookup = lookup
+
+    def __getitem__(self, node):
+        return self.lookup(self.city.node_index[node])
+
+    def __iter__(self):
+        return iter(self.city.network_keys)
+
+    def __len__(self):
+        return len(self.city.network_keys)
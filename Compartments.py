@@ -0,0 +1,186 @@
+import math
+import numpy as np
+
+# Integer codes of the compartments a node can be in. Cities store these
+# as uint8 values in a contiguous state array, one entry per node.
+SUSCEPTIBLE = 0
+EXPOSED = 1
+INFECTED = 2
+REMOVED = 3
+
+# Names of the compartments, indexed by their code
+STATE_NAMES = ("Susceptible", "Exposed", "Infected", "Removed")
+
+# Value of the transition day array for nodes that are not scheduled to change state
+NO_TRANSITION = -1
+
+# Distributions of the dwell time of a compartment around its mean: exactly the
+# mean, geometric (a constant chance of leaving every day) or a discretized
+# gamma, given with its shape as (GAMMA, shape)
+FIXED = "fixed"
+GEOMETRIC = "geometric"
+GAMMA = "gamma"
+TAIL = 1e-9 # probability mass of the dwell times left out of the tables
+
+class CompartmentModel:
+    """Declarative description of a compartment model. compartments lists the
+    names of the compartments, the first one being the susceptible compartment,
+    and their position is their code in the state arrays. Infection moves a
+    susceptible node into the infection compartment, and the initially infected
+    nodes start in the seed compartment. dwell maps every compartment that nodes
+    leave on their own to its dwell time in days, given as a number or as the
+    name of a City attribute ("sigma", "mu"), and the dwell time of the jittered
+    compartments is changed by the infectious period range of each step.
+    distributions maps compartments to the distribution of their dwell time
+    around that mean (FIXED when not given). transitions maps the compartments
+    of dwell to their (next compartment, probability) branches. infectious maps
+    the compartments that transmit to their relative infectiousness, and the
+    removed compartments are counted in number_removed."""
+    def __init__(self, compartments, infection, seed, dwell, transitions, infectious,
+                 removed=(), jittered=(), distributions=None):
+        self.compartments = tuple(compartments)
+        self.infection = infection
+        self.seed = seed
+        self.dwell = dict(dwell)
+        self.transitions = dict(transitions)
+        self.infectious = dict(infectious)
+        self.removed = tuple(removed)
+        self.jittered = tuple(jittered)
+        self.distributions = dict(distributions) if distributions is not None else {}
+
+    def compile(self, city):
+        """Compile the model into the array tables used by the step kernel of a city"""
+        return CompiledModel(self, city)
+
+class CompiledModel:
+    """Array tables of a CompartmentModel for one city, all indexed by compartment code"""
+    def __init__(self, model, city):
+        validate(model)
+        size = len(model.compartments)
+        code = {name: i for i, name in enumerate(model.compartments)}
+        self.model = model
+        self.names = model.compartments
+        self.infection = code[model.infection]
+        self.seed = code[model.seed]
+        self.dwell = np.zeros(size, dtype=np.int64) # 0 for the compartments nodes never leave on their own
+        for name, days in model.dwell.items():
+            self.dwell[code[name]] = getattr(city, days) if isinstance(days, str) else days
+        self.jittered = np.zeros(size, dtype=bool)
+        self.jittered[[code[name] for name in model.jittered]] = True
+        # cumulative probabilities of the dwell times 1, 2, ... of the compartments without a fixed one
+        self.sampled = np.zeros(size, dtype=bool)
+        self.tables = {}
+        for name, distribution in model.distributions.items():
+            if distribution != FIXED:
+                self.sampled[code[name]] = True
+                self.tables[code[name]] = dwell_table(distribution, self.dwell[code[name]])
+        self.infectiousness = np.zeros(size)
+        for name, weight in model.infectious.items():
+            self.infectiousness[code[name]] = weight
+        self.removed = np.zeros(size, dtype=bool)
+        self.removed[[code[name] for name in model.removed]] = True
+        # cumulative branch probabilities over the next compartment codes
+        self.cumulative = np.ones((size, size))
+        for name, branches in model.transitions.items():
+            row = np.zeros(size)
+            for destination, probability in branches:
+                row[code[destination]] += probability
+            self.cumulative[code[name]] = np.cumsum(row) / row.sum()
+            self.cumulative[code[name], -1] = 1.0
+
+    def next_compartments(self, codes, draws):
+        """Next compartment of nodes leaving the given compartments, from one uniform draw per node"""
+        return (draws[:, None] >= self.cumulative[codes]).sum(axis=1).astype(np.uint8)
+
+    def dwell_times(self, codes, onset_low, onset_high, draws):
+        """Dwell times of nodes entering the given compartments, drawn from their
+        distributions, with the jittered compartments changed by
+        randint(onset_low, onset_high), from one uniform draw per node"""
+        days = self.dwell[codes]
+        jittered = self.jittered[codes]
+        days[jittered] += onset_low + (draws[jittered] * (onset_high - onset_low + 1)).astype(np.int64)
+        if self.sampled[codes].any():
+            for code, table in self.tables.items():
+                entering = codes == code
+                days[entering] = np.searchsorted(table, draws[entering], side='right') + 1
+        return np.maximum(days, 1)
+
+def validate(model):
+    # raises ValueError for a model whose compartments leave on their own
+    # without branches to go to, or whose distributions do not apply
+    if set(model.dwell) != set(model.transitions):
+        raise ValueError("The dwell times and transitions of a compartment model must cover the same compartments, "
+                         "not " + ", ".join(sorted(set(model.dwell) ^ set(model.transitions))))
+    for name, distribution in model.distributions.items():
+        kind = distribution[0] if isinstance(distribution, tuple) else distribution
+        if name not in model.dwell:
+            raise ValueError("The compartment " + name + " has a dwell time distribution but no dwell time")
+        if kind not in (FIXED, GEOMETRIC, GAMMA) or (kind == GAMMA) != isinstance(distribution, tuple):
+            raise ValueError("Unknown dwell time distribution " + repr(distribution) + " of " + name)
+        if kind == GAMMA and not distribution[1] > 0:
+            raise ValueError("The gamma dwell time of " + name + " needs a positive shape")
+        if kind != FIXED and name in model.jittered:
+            raise ValueError("The compartment " + name + " cannot be both jittered and drawn from a distribution")
+
+def dwell_table(distribution, mean):
+    # cumulative probabilities of the dwell times 1, 2, ... days of a
+    # distribution with the given mean, up to a tail of TAIL
+    if distribution == GEOMETRIC: # days >= 1 with a chance 1 / mean of leaving on each
+        leave = min(1.0, 1.0 / max(mean, 1))
+        days = 1 if leave == 1.0 else math.ceil(math.log(TAIL) / math.log1p(-leave))
+        cumulative = 1.0 - (1.0 - leave) ** np.arange(1, days + 1)
+    else: # gamma of the given shape and mean rounded to whole days, integrated
+        # by the midpoint rule, with the first day holding the mass below 1.5
+        shape = distribution[1]
+        scale = max(mean, 1) / shape
+        steps = 64 # integration points per day
+        days = int(math.ceil(max(mean, 1) * 10 + 10 * math.sqrt(shape) * scale))
+        x = (np.arange((days + 1) * steps) + 0.5) / steps
+        density = np.exp((shape - 1) * np.log(x) - x / scale - math.lgamma(shape) - shape * math.log(scale))
+        cumulative = np.cumsum(density)[np.arange(1, days + 1) * steps + steps // 2 - 1]
+        cumulative = cumulative[:np.searchsorted(cumulative / cumulative[-1], 1.0 - TAIL) + 1] / cumulative[-1]
+    cumulative[-1] = 1.0
+    return cumulative
+
+# The SEIR model of the original simulation: exposed nodes become infected
+# after sigma days and are removed after mu days plus the step's range
+SEIR_MODEL = CompartmentModel(
+    STATE_NAMES, infection="Exposed", seed="Infected",
+    dwell={"Exposed": "sigma", "Infected": "mu"},
+    transitions={"Exposed": [("Infected", 1.0)], "Infected": [("Removed", 1.0)]},
+    infectious={"Infected": 1.0}, removed=("Removed",), jittered=("Infected",))
+
+# SEIR with waning immunity: removed nodes become susceptible again after 180 days
+SEIRS_MODEL = CompartmentModel(
+    STATE_NAMES, infection="Exposed", seed="Infected",
+    dwell={"Exposed": "sigma", "Infected": "mu", "Removed": 180},
+    transitions={"Exposed": [("Infected", 1.0)], "Infected": [("Removed", 1.0)],
+                 "Removed": [("Susceptible", 1.0)]},
+    infectious={"Infected": 1.0}, removed=("Removed",), jittered=("Infected",))
+
+# SEIR with 40% of the infections asymptomatic and half as infectious
+ASYMPTOMATIC_MODEL = CompartmentModel(
+    STATE_NAMES + ("Asymptomatic",), infection="Exposed", seed="Infected",
+    dwell={"Exposed": "sigma", "Infected": "mu", "Asymptomatic": "mu"},
+    transitions={"Exposed": [("Infected", 0.6), ("Asymptomatic", 0.4)],
+                 "Infected": [("Removed", 1.0)], "Asymptomatic": [("Removed", 1.0)]},
+    infectious={"Infected": 1.0, "Asymptomatic": 0.5}, removed=("Removed",),
+    jittered=("Infected", "Asymptomatic"))
+
+# SEIR where 5% of the infected nodes are hospitalized, and isolated, for 10 more days
+HOSPITALIZED_MODEL = CompartmentModel(
+    STATE_NAMES + ("Hospitalized",), infection="Exposed", seed="Infected",
+    dwell={"Exposed": "sigma", "Infected": "mu", "Hospitalized": 10},
+    transitions={"Exposed": [("Infected", 1.0)],
+                 "Infected": [("Removed", 0.95), ("Hospitalized", 0.05)],
+                 "Hospitalized": [("Removed", 1.0)]},
+    infectious={"Infected": 1.0}, removed=("Removed",), jittered=("Infected",))
+
+# SEIR with a geometric latent period and an infectious period following a
+# gamma distribution of shape 4, instead of the fixed sigma and mu
+DISTRIBUTED_SEIR_MODEL = CompartmentModel(
+    STATE_NAMES, infection="Exposed", seed="Infected",
+    dwell={"Exposed": "sigma", "Infected": "mu"},
+    transitions={"Exposed": [("Infected", 1.0)], "Infected": [("Removed", 1.0)]},
+    infectious={"Infected": 1.0}, removed=("Removed",),
+    distributions={"Exposed": GEOMETRIC, "Infected": (GAMMA, 4.0)})
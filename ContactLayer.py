@@ -0,0 +1,52 @@
+import numpy as np
+from AdjacencyStore import share_array, open_array
+
+class ContactLayer:
+    """One named layer of contacts of a city (street/household, daily mobility,
+    workplace, ...), stored as a CSR adjacency (indptr, indices) over the dense
+    node indices of the city. Every layer has its own transmission probability
+    per contact, and a scale that mitigation measures can turn down without
+    touching the adjacency. Daily layers are dropped at the end of the step
+    that uses them."""
+    def __init__(self, indptr, indices, transmission, daily=False):
+        self.indptr = indptr
+        self.indices = indices
+        self.transmission = transmission
+        self.scale = 1.0
+        self.daily = daily
+
+    def copy(self):
+        """Copy of the layer sharing its adjacency arrays"""
+        layer = ContactLayer(self.indptr, self.indices, self.transmission, self.daily)
+        layer.scale = self.scale
+        return layer
+
+    def __getstate__(self):
+        # memory-mapped adjacencies travel to worker processes as their file paths
+        state = self.__dict__.copy()
+        state["indptr"] = share_array(self.indptr)
+        state["indices"] = share_array(self.indices)
+        return state
+
+    def __setstate__(self, state):
+        state["indptr"] = open_array(state["indptr"])
+        state["indices"] = open_array(state["indices"])
+        self.__dict__.update(state)
+
+    def probability(self):
+        """Transmission probability of a contact of this layer after scaling"""
+        return min(1.0, self.transmission * self.scale)
+
+    def neighbors(self, node_index):
+        """Dense indices of the contacts of a node in this layer"""
+        return self.indices[self.indptr[node_index]:self.indptr[node_index + 1]].tolist()
+
+    def thin(self, retention, rng):
+        """Copy of this layer keeping every contact with probability retention"""
+        kept = rng.random(len(self.indices)) < retention
+        rows = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        indptr = np.zeros(len(self.indptr), dtype=np.int64)
+        np.cumsum(np.bincount(rows[kept], minlength=len(self.indptr) - 1), out=indptr[1:])
+        layer = ContactLayer(indptr, self.indices[kept], self.transmission, self.daily)
+        layer.scale = self.scale
+        return layer
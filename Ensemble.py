@@ -0,0 +1,211 @@
+import numpy as np
+from itertools import chain
+from ArrayEngine import gather_entries
+from Sampling import select_random
+from City import SEIR_PARAMETERS, SD_SEIR_PARAMETERS
+from Compartments import SUSCEPTIBLE
+from RandomStreams import ENSEMBLE, TRANSMISSION, PROGRESSION, THINNING, name_key, keyed_uniforms
+
+CHUNK = 1 << 22 # (contact, replica) pairs looked at at once, to bound the temporaries
+SHARED = 16 # a node infectious in at least 1/SHARED of the replicas has its contacts looked at once for all of them
+
+class Ensemble:
+    """Advances K independent replicas of the outbreak on one City graph under
+    the compartment model of the city. The compartments are held in an N x K
+    uint8 array (one row of K replicas per node). The contacts of a node that
+    is infectious in many replicas are gathered once and checked for all of
+    them row by row, and those of the other infectious (node, replica)
+    positions one position at a time. What the ensemble saves is building and
+    rewiring the City graph for every replica: the per-contact work of a step
+    grows with the infectious positions of all the replicas, so a replica
+    costs about as much to step as a City. Replica r draws from the streams of
+    replica r of the city, or of the given RandomStreams, with every draw
+    keyed by its contact or node, so its trajectory does not depend on the
+    number of replicas. The number of nodes in each compartment is recorded
+    per replica after every step."""
+    def __init__(self, city, replicas, streams=None):
+        self.city = city
+        self.replicas = replicas
+        self.streams = streams if streams is not None else city.streams
+        self.layer_scales = {} # mitigation scale of the layers, apart from the scales of the city
+        self.state = np.full((len(city.network_keys), replicas), SUSCEPTIBLE, dtype=np.uint8)
+        self.init_infection(city.init_infections)
+
+    def init_infection(self, number_initial_infections):
+        """Infect the same number of distinct random nodes in every replica"""
+        self.state[:] = SUSCEPTIBLE
+        self.day = 0
+        self.period = 0 # day the contacts kept under social distancing were drawn
+        self.thinning = None # contact rate they were drawn for, None until the next distancing day
+        self.bases = {}
+        self.calendar = {}
+        self.counts = np.zeros((len(self.city.model.names), self.replicas), dtype=np.int64) # nodes per compartment and replica
+        self.counts[SUSCEPTIBLE] = len(self.city.network_keys)
+        number_initial_infections = min(number_initial_infections, len(self.city.network_keys))
+        seeds = [select_random(number_initial_infections, len(self.city.network_keys),
+                               self.streams.for_replica(replica).generator(ENSEMBLE, self.city.stream_index))
+                 for replica in range(self.replicas)]
+        nodes = np.concatenate(seeds).astype(np.int64)
+        replicas = np.repeat(np.arange(self.replicas), number_initial_infections)
+        # flat positions (node * K + replica) of the infected nodes of all replicas
+        self.infected = nodes * self.replicas + replicas
+        seed = self.city.model.seed
+        self.state.ravel()[self.infected] = seed
+        self.enter(self.infected, -1, seed, self.city.model)
+        self.counts[SUSCEPTIBLE] -= number_initial_infections
+        self.counts[seed] += number_initial_infections
+        self.history = [self.counts.copy()]
+
+    def schedule(self, positions, day):
+        """Queue flat positions to leave their current state on the given day"""
+        if day in self.calendar:
+            self.calendar[day].append(positions)
+        else:
+            self.calendar[day] = [positions]
+
+    def enter(self, positions, day, code, model):
+        """Queue flat positions entering a compartment on the given day to leave it
+        after its dwell time, drawn per position when it has a distribution"""
+        if not model.sampled[code]:
+            self.schedule(positions, day + int(model.dwell[code]))
+            return
+        days = day + model.dwell_times(np.full(len(positions), code, dtype=np.uint8), 0, 0, self.draws(positions, 2))
+        for transition_day in np.unique(days):
+            self.schedule(positions[days == transition_day], int(transition_day))
+
+    def uniforms(self, purpose, day, keys, replicas, salt):
+        """Uniform draws keyed by the given keys on the stream of their replica for a purpose and day"""
+        if (purpose, day) not in self.bases:
+            self.bases[(purpose, day)] = np.array([self.streams.for_replica(replica).base(purpose, self.city.stream_index, day)
+                                                   for replica in range(self.replicas)], dtype=np.uint64)
+        return keyed_uniforms(self.bases[(purpose, day)][replicas], keys, salt)
+
+    def draws(self, positions, salt):
+        """One uniform draw per flat position for the current day, keyed by its node"""
+        return self.uniforms(PROGRESSION, self.day, positions // self.replicas, positions % self.replicas, salt)
+
+    def run_seir(self, number_of_steps):
+        """Run the unmitigated SEIR model on every replica for a given number of steps"""
+        for step in range(number_of_steps):
+            self.step(*SEIR_PARAMETERS)
+
+    def run_sd_seir(self, number_of_steps, severity):
+        """Run the social distancing SEIR model on every replica for a given number of steps"""
+        for step in range(number_of_steps):
+            self.step(*SD_SEIR_PARAMETERS)
+
+    def new_policy_period(self):
+        """Forget the contacts kept under social distancing, so the next distancing day draws new ones"""
+        self.thinning = None
+
+    def run_day(self, parameters, mobility_scale=None, new_period=False):
+        """Run one day on every replica with the step parameters, mobility layer
+        scale and policy period flag of a compiled policy, like City.run_day"""
+        if new_period:
+            self.new_policy_period()
+        if mobility_scale is not None:
+            self.layer_scales["mobility"] = mobility_scale
+        self.step(*parameters)
+
+    def step(self, multiplier, contact_rate, onset_low, onset_high):
+        """Advance every replica by one day, with the same parameters as City.step"""
+        state = self.state.ravel()
+        model = self.city.model
+
+        if contact_rate < 1.0 and contact_rate != self.thinning:
+            # every replica keeps each contact with probability contact_rate until
+            # the next policy period, like the thinned layers of the city
+            self.period = self.day
+            self.thinning = contact_rate
+
+        # the contacts, in every layer, of the infectious (node, replica) positions
+        nodes = self.infected // self.replicas
+        counts = np.bincount(nodes, minlength=len(self.state))
+        shared = (counts * SHARED >= self.replicas) & (counts > 1)
+        shared_nodes = np.flatnonzero(shared)
+        single = self.infected[~shared[nodes]]
+        targets = [np.empty(0, dtype=np.int64)]
+        for name, layer in self.city.layers.items():
+            probability = min(1.0, layer.transmission * self.layer_scales.get(name, layer.scale)) * multiplier
+            salt = name_key(name)
+            for entries, replicas, infectiousness in chain(self.shared_contacts(layer, shared_nodes),
+                                                           self.single_contacts(layer, single)):
+                hit = self.uniforms(TRANSMISSION, self.day, entries, replicas, salt) < np.minimum(1.0, probability * infectiousness)
+                entries, replicas = entries[hit], replicas[hit]
+                if contact_rate < 1.0:
+                    kept = self.uniforms(THINNING, self.period, entries, replicas, salt) < contact_rate
+                    entries, replicas = entries[kept], replicas[kept]
+                targets.append(layer.indices[entries] * self.replicas + replicas)
+        targets = np.unique(np.concatenate(targets))
+        state[targets] = model.infection
+        self.enter(targets, self.day, model.infection, model)
+        self.move(targets, np.zeros(len(targets), dtype=np.uint8), np.full(len(targets), model.infection, dtype=np.uint8))
+        if model.infectiousness[model.infection] > 0:
+            self.infected = np.concatenate((self.infected, targets))
+
+        # only the positions whose transition falls on today are progressed
+        due = self.calendar.pop(self.day, [])
+        due = np.concatenate(due) if due else np.empty(0, dtype=np.int64)
+
+        source = state[due]
+        destination = model.next_compartments(source, self.draws(due, 0))
+        state[due] = destination
+        self.move(due, source, destination)
+        timed = model.dwell[destination] > 0
+        positions = due[timed]
+        days = self.day + model.dwell_times(destination[timed], onset_low, onset_high, self.draws(positions, 1))
+        for transition_day in np.unique(days):
+            self.schedule(positions[days == transition_day], int(transition_day))
+
+        was_infectious = model.infectiousness[source] > 0
+        now_infectious = model.infectiousness[destination] > 0
+        if (was_infectious & ~now_infectious).any():
+            self.infected = self.infected[model.infectiousness[state[self.infected]] > 0]
+        self.infected = np.concatenate((self.infected, due[now_infectious & ~was_infectious]))
+
+        self.day += 1
+        self.bases = {key: bases for key, bases in self.bases.items() if key == (THINNING, self.period)}
+        self.history.append(self.counts.copy())
+
+    def shared_contacts(self, layer, nodes):
+        """(contact entries, replicas, infectiousness) of the contacts of the given nodes
+        with nodes susceptible in the replicas they are infectious in. The contacts of
+        a node are gathered once, and both ends compared for all the replicas at once"""
+        counts = layer.indptr[nodes + 1] - layer.indptr[nodes]
+        for chunk in np.split(np.arange(len(nodes)), chunk_bounds(counts * self.replicas)):
+            entries = gather_entries(layer.indptr, nodes[chunk])
+            sources = np.repeat(np.arange(len(chunk)), counts[chunk])
+            infectiousness = self.city.model.infectiousness[self.state[nodes[chunk]]] # chunk x K
+            candidates = (infectiousness > 0)[sources] & (self.state[layer.indices[entries]] == SUSCEPTIBLE)
+            contacts, replicas = np.divmod(np.flatnonzero(candidates), self.replicas)
+            yield entries[contacts], replicas, infectiousness[sources[contacts], replicas]
+
+    def single_contacts(self, layer, positions):
+        """(contact entries, replicas, infectiousness) of the contacts of the given flat
+        positions with nodes susceptible in their replica"""
+        state = self.state.ravel()
+        nodes = positions // self.replicas
+        counts = layer.indptr[nodes + 1] - layer.indptr[nodes]
+        for chunk in np.split(np.arange(len(positions)), chunk_bounds(counts)):
+            entries = gather_entries(layer.indptr, nodes[chunk])
+            replicas = np.repeat(positions[chunk] % self.replicas, counts[chunk])
+            infectiousness = np.repeat(self.city.model.infectiousness[state[positions[chunk]]], counts[chunk])
+            susceptible = state[layer.indices[entries] * self.replicas + replicas] == SUSCEPTIBLE
+            yield entries[susceptible], replicas[susceptible], infectiousness[susceptible]
+
+    def move(self, positions, source, destination):
+        """Update the per-replica compartment counts for positions moving between the
+        source and destination compartment codes"""
+        replicas = positions % self.replicas
+        np.subtract.at(self.counts, (source, replicas), 1)
+        np.add.at(self.counts, (destination, replicas), 1)
+
+    def time_series(self):
+        """Compartment sizes of every replica over time, as a (days + 1) x C x K array
+        indexed by day, compartment code and replica"""
+        return np.array(self.history)
+
+def chunk_bounds(sizes):
+    # split points of consecutive runs of items whose sizes add up to about CHUNK each
+    ends = np.cumsum(sizes)
+    return np.unique(np.searchsorted(ends, np.arange(CHUNK, ends[-1] if len(ends) else 0, CHUNK), side='right'))
@@ -0,0 +1,75 @@
+import hashlib
+import os
+import shutil
+import networkx as nx
+import numpy as np
+from AdjacencyStore import write_entry
+
+class GraphCache:
+    """Content-addressed on-disk cache of the rewired city graphs made by
+    City.init_graph. An entry is keyed by the hash of the source graph, the
+    density, the number of swaps and the seed, and holds the edges the rewiring
+    removed and added, replayed on the source graph on a hit, and the CSR
+    adjacency of the rewired graph as .npy files, loaded memory-mapped. Cities
+    only use it with seeded streams, as other seeds never come back. networkx
+    graphs are cached when their node ids are integers (like OSM street
+    networks), and StreetGraphs always. Every seed adds an entry, so with
+    max_entries the least recently used entries beyond it are deleted."""
+    def __init__(self, directory, max_entries=None):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, network, density, swaps, seed):
+        """Key of a rewiring, or None if the graph cannot be cached"""
+        digest = hashlib.sha256()
+        if isinstance(network, nx.Graph):
+            if not all(isinstance(node, (int, np.integer)) for node in network):
+                return None
+            digest.update(np.array(list(network.nodes()), dtype=np.int64).tobytes())
+            digest.update(np.array(list(network.edges()), dtype=np.int64).tobytes())
+        else: # a StreetGraph
+            digest.update(np.asarray(network.keys).tobytes())
+            digest.update(np.stack((network.sources, network.targets), axis=1).astype(np.int64).tobytes())
+        digest.update(("%r:%d:%d" % (density, swaps, seed)).encode())
+        return digest.hexdigest()
+
+    def path(self, key, name):
+        return os.path.join(self.directory, key, name + ".npy")
+
+    def replay(self, key, network):
+        """Apply the cached rewiring to the source graph in place, and return whether there was one"""
+        if not os.path.exists(self.path(key, "indices")):
+            return False
+        network.remove_edges_from(np.load(self.path(key, "removed")).tolist())
+        network.add_edges_from(np.load(self.path(key, "added")).tolist())
+        return True
+
+    def adjacency(self, key):
+        """Memory-mapped (indptr, indices) of a cached rewired graph, or None"""
+        if not os.path.exists(self.path(key, "indices")):
+            return None
+        os.utime(os.path.join(self.directory, key)) # recently used, for eviction
+        return np.load(self.path(key, "indptr"), mmap_mode='r'), np.load(self.path(key, "indices"), mmap_mode='r')
+
+    def store(self, key, removed, added, indptr, indices):
+        """Add an entry, written to a temporary directory and moved into place"""
+        arrays = {"removed": np.array(removed, dtype=np.int64).reshape(-1, 2),
+                  "added": np.array(added, dtype=np.int64).reshape(-1, 2),
+                  "indptr": indptr, "indices": indices}
+        write_entry(self.directory, key, arrays)
+        self.evict()
+
+    def entries(self):
+        """Keys of the stored entries, least recently used first"""
+        keys = [name for name in os.listdir(self.directory)
+                if os.path.exists(self.path(name, "indices")) and not name.startswith("tmp")]
+        return sorted(keys, key=lambda key: os.path.getmtime(os.path.join(self.directory, key)))
+
+    def evict(self):
+        """Delete the least recently used entries beyond max_entries"""
+        if self.max_entries is None:
+            return
+        keys = self.entries()
+        for key in keys[:max(0, len(keys) - self.max_entries)]:
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
@@ -0,0 +1,43 @@
+import warnings
+import numpy as np
+
+# Optional machine code kernels for ArrayEngine. Numba is not a requirement of
+# the simulation: when it is not installed, kernel() returns None and the
+# engine keeps its NumPy path.
+try:
+    import numba
+except ImportError:
+    numba = None
+
+prange = numba.prange if numba is not None else range
+
+def transmit(indptr, indices, sources, probabilities, offsets, draws, state, susceptible, hit):
+    # walks the CSR neighbor list of every source node and marks the susceptible
+    # neighbors reached by a transmission. draws holds one uniform number per
+    # contact, starting at offsets[i] for the i-th source, so the result only
+    # depends on the draws and not on how the sources are split across threads
+    for i in prange(len(sources)):
+        node = sources[i]
+        start = indptr[node]
+        for k in range(indptr[node + 1] - start):
+            neighbor = indices[start + k]
+            if state[neighbor] == susceptible and draws[offsets[i] + k] < probabilities[i]:
+                hit[neighbor] = True
+
+_kernels = {}
+
+def kernel(parallel=False):
+    # compiled transmit kernel, split across cores when parallel, or None without Numba
+    if numba is None:
+        warnings.warn("Numba is not installed, falling back to the NumPy engine")
+        return None
+    if parallel not in _kernels:
+        _kernels[parallel] = numba.njit(parallel=parallel, cache=True)(transmit)
+    return _kernels[parallel]
+
+def contact_offsets(indptr, sources):
+    # number of contacts of every source node and the offset of its first draw
+    counts = indptr[sources + 1] - indptr[sources]
+    offsets = np.zeros(len(sources), dtype=np.int64)
+    np.cumsum(counts[:-1], out=offsets[1:])
+    return counts, offsets
@@ -6,15 +6,19 @@ import matplotlib.pyplot as plt
 from cartopy import geodesic
 import cartopy.crs as ccrs
 import networkx as nx
-from City import City
+import numpy as np
+from City import City, SEIR_PARAMETERS, SD_SEIR_PARAMETERS
+from ParallelDay import CityPool
+from RandomStreams import RandomStreams
+from Policy import Intervention, PolicyTimeline
+from StreetNetworks import StreetNetworks
 import osmnx as ox
 import shapely
 import cartopy
 import pickle
-import random
 import math
 import matplotlib as mpl
-from copy import deepcopy
+from copy import copy, deepcopy
 
 mpl.rcParams['figure.dpi'] = 300
 
@@ -25,7 +29,6 @@ mpl.rcParams['figure.dpi'] = 300
 # credit to: https://scitools.org.uk/cartopy/docs/v0.15/examples/hurricane_katrina.html
 # credit to: 
 
-TOTAL_CASES = []
 GEOSCRAPE_DICT = {}
 INF_PLOT = {"Boston, Massachusetts, USA": ((9,-3), (9, -5)),
 "Dallas, Texas, USA": ((-0.5, -0.5), (0, -2)),
@@ -36,6 +39,16 @@ INF_PLOT = {"Boston, Massachusetts, USA": ((9,-3), (9, -5)),
 "Seattle, Washington, USA": ((-2, -2), (-2, -3.5)),
 "Los Angeles, California, USA": ((-2, -2), (-2, -3.5))}
 
+class Snapshot:
+    """State of an OutbreakNetwork at the start of a day, made by
+    OutbreakNetwork.snapshot. Its cities are forks that are never stepped, so
+    any number of branches can be started from it"""
+    def __init__(self, day, cities, total_cases, pending_mobility):
+        self.day = day
+        self.cities = cities
+        self.total_cases = total_cases
+        self.pending_mobility = pending_mobility
+
 class OutbreakNetwork:
     """This class bridges City objects by creating edges between Cities that represent the 
     single-day throughput from one city to another via airplane travel. It reads in 
@@ -45,14 +58,31 @@ class OutbreakNetwork:
     grounding of flights (infected nodes are no longer transmitted from city to 
     city), and social distancing implemented through the SEIR method run in each city. This
     is all plotted against a map of the US, and additionally the growth curve is plotted 
-    at the end of the simulation."""
-    def __init__(self, input_file, cities):
+    at the end of the simulation. With workers > 0 the cities are stepped in parallel
+    on that many worker processes, which each keep their own share of the cities.
+    Travel is drawn from the streams of the network, which the cities should be
+    built with too (each with its position as index) for reproducible runs.
+    With an AdjacencyStore the city adjacencies are moved there before the
+    workers start, so all the workers share one mapped copy of them. The cities
+    of the flight data that are not given are built from the street networks
+    of StreetNetworks, which loads them offline from its cache or local files."""
+    def __init__(self, input_file, cities, workers=0, streams=None, adjacency_store=None, street_networks=None):
         # creates an OutbreakNetwork object 
         self.network = nx.DiGraph()
         self.cities = cities
         self.annotations = []
         self.geometries = []
+        self.total_cases = [] # total number of infected nodes on every plotted day
+        self.pending_mobility = None
+        self.streams = streams if streams is not None else RandomStreams()
+        self.street_networks = street_networks
+        self.day = 0
         self.populate_graph(input_file)
+        self.build_flows()
+        if adjacency_store is not None:
+            for city in self.cities:
+                city.share_adjacency(adjacency_store)
+        self.pool = CityPool(self.cities, workers) if workers > 0 else None
 
     # NETWORK ASSEMBLY
     def populate_graph(self, input_file):
@@ -66,6 +96,18 @@ class OutbreakNetwork:
             city_1 = self.retrieve_city(edges[0])
             city_2 = self.retrieve_city(edges[1])
             self.network.add_weighted_edges_from([(city_1, city_2, edges[2]), (city_2, city_1, edges[3])])
+    def build_flows(self):
+        # builds the city x city matrix of daily travellers, in nodes of the
+        # source city, from the flight capacities on the edges
+        self.populations = np.array([len(city.network_keys) for city in self.cities])
+        flows = np.zeros((len(self.cities), len(self.cities)))
+        positions = {city: i for i, city in enumerate(self.cities)}
+        for u, v, weight in self.network.edges(data='weight'):
+            if weight is not None:
+                flows[positions[u], positions[v]] += int(weight)
+        densities = np.array([city.density for city in self.cities], dtype=float)
+        self.flows = flows # flight capacities, in people
+        self.travellers = (flows / densities[:, None]).astype(np.int64)
     def retrieve_city(self, name):
         # retrieves a city from the network or creates it if it does not exist
         for city in self.cities:
@@ -73,90 +115,163 @@ class OutbreakNetwork:
             if city.city_name == name:
                 return city
         print("New city: ", name)
-        city = City(name, 1)
+        if self.street_networks is None:
+            raise ValueError("No street network for " + name + ", pass its City or a StreetNetworks")
+        city = City(name, 1, self.street_networks.load(name), self.street_networks.density(name),
+                    streams=self.streams, index=len(self.cities), graph_cache=self.street_networks.graph_cache)
         self.cities.append(city)
         self.network.add_node(city)
         print(len(city.network_keys))
         return city
 
     # SIMULATION FUNCTIONS
-    def simulate_travel(self, steps, mitigation_day, fig, ax):
-        # simulates travel and transmission of infected nodes between cities
-        for i in range(steps):
+    def simulate_travel(self, steps, mitigation_day, fig, ax, checkpoints=None):
+        # simulates travel and transmission of infected nodes between cities,
+        # with social distancing and grounded flights from mitigation_day on
+        lockdown = Intervention(mitigation_day, beta_multiplier=SD_SEIR_PARAMETERS[0],
+                                contact_rate=SD_SEIR_PARAMETERS[1], travel_cap=0.0)
+        self.simulate_policy(steps, PolicyTimeline([lockdown]), fig, ax, checkpoints)
+    def simulate_policy(self, steps, timeline, fig, ax, checkpoints=None):
+        # simulates the outbreak under a timeline of interventions, which is
+        # compiled up front into per-day, per-city parameter arrays. the run
+        # continues from the current day, so a network restored from a
+        # checkpoint picks up where it stopped, and checkpoints (a Checkpointer)
+        # saves the state in the background every few days
+        policy = timeline.compile(steps, self.cities)
+        for i in range(self.day, steps):
             print(i)
-            if i < mitigation_day:
-                figi = str(i) + ".png"
-                self.simulate_mobility(0, 0)
-                self.travel_step()
-                self.plot_infections(ax, i, False)
-                plt.savefig(figi)
-                self.remove_annotations(fig)
-            else:
-                figi = str(i) + ".png"
-                self.simulate_mobility(0, 2)
-                self.mitigation_step()
-                self.plot_infections(ax, i, True)
-                plt.savefig(figi)
-                self.remove_annotations(fig)
+            figi = str(i) + ".png"
+            self.policy_step(policy, i)
+            self.plot_infections(ax, i, policy.active[i].any())
+            plt.savefig(figi)
+            self.remove_annotations(fig)
+            if checkpoints is not None:
+                checkpoints.save(self)
+        if checkpoints is not None:
+            checkpoints.wait()
+    def policy_step(self, policy, day):
+        # simulates a day of mobility, travel and city activity with the
+        # parameters the compiled policy sets for that day
+        settings = [(policy.step_parameters(day, i), float(policy.mobility_scale[day, i]), bool(policy.new_period[day, i]))
+                    for i in range(len(self.cities))]
+        self.simulate_mobility(0, 0)
+        self.network_step(self.draw_imports(policy.travel_cap[day]), settings)
     def travel_step(self):
         # simulates a day of travel and city activity
-        # the transmission of infected nodes is roughly associated
-        # with the ratio of infected nodes to total nodes in the 
-        # first city in each edge
-        for u, v, weight in self.network.edges(data='weight'):
-            if weight is not None:
-                threshold = u.number_infected/len(u.network_keys)
-                chance = random.random()
-                infected_throughput = int((int(weight)/u.density) * threshold)
-                print("beta:" + str(infected_throughput))
-                if chance < (int(weight) * threshold):
-                    v.introduce_infected_node()
-                for i in range(infected_throughput):
-                    v.introduce_infected_node()
-        self.network_seir(0)
+        self.network_step(self.draw_imports(None), [(SEIR_PARAMETERS, None, False)] * len(self.cities))
     def mitigation_step(self):
         # simulates a day of travel and city activity with lockdown measures in place
         # this means social distancing implemented through an altered SEIR function
         # and the grounding of travel
-        self.network_seir(1)
-    def network_seir(self, mitigation):
-        # iterates through all the cities after network transmission (or lack
-        # thereof) and runs them through a step of the SEIR algorithm, with
-        # the ability to implement mitgation measures 
-        if mitigation == 0:
-            for city in self.cities:
-                city.run_seir(1)
+        self.network_step({}, [(SD_SEIR_PARAMETERS, None, False)] * len(self.cities))
+    def draw_imports(self, travel_cap):
+        # every traveller on a route is infected with the prevalence (ratio of
+        # infected nodes to total nodes) of its source city, so the imports
+        # of all routes are drawn at once as binomial samples. As in the
+        # original travel loop, every route also carries one more infected
+        # traveller with probability capacity x prevalence, capped at 1.
+        # travel_cap is None or the fraction of travel still allowed in and
+        # out of every city
+        flows, travellers = self.flows, self.travellers
+        if travel_cap is not None:
+            cap = np.minimum.outer(travel_cap, travel_cap)
+            flows, travellers = flows * cap, (travellers * cap).astype(np.int64)
+        prevalence = np.array([city.number_infected for city in self.cities]) / self.populations
+        rng = self.streams.travel(self.day)
+        infected_throughput = rng.binomial(travellers, prevalence[:, None])
+        infected_throughput += rng.random(flows.shape) < np.minimum(1.0, flows * prevalence[:, None])
+        arrivals = infected_throughput.sum(axis=0)
+        return {city: int(count) for city, count in zip(self.cities, arrivals) if count > 0}
+    def network_step(self, imports, settings):
+        # introduces the imported cases in every city and runs them through a
+        # step of the SEIR algorithm. settings holds, for every city in order,
+        # the arguments of City.run_day. with a worker pool the whole day runs
+        # on the workers
+        if self.pool is not None:
+            self.pool.step(self.pending_mobility, imports, settings)
+            self.pending_mobility = None
         else:
-            for city in self.cities:
-                city.run_sd_seir(1, 2)
+            for city, count in imports.items():
+                city.introduce_infected_nodes(count)
+            for city, setting in zip(self.cities, settings):
+                city.run_day(*setting)
+        self.day += 1
     def simulate_mobility(self, mitigation, mitigation_severity):
         # creates random connections to simulate connections/interactions
-        # between people who do not live together
+        # between people who do not live together. the workers own the city
+        # graphs when running in parallel, so it is sent along with the next step
+        if self.pool is not None:
+            self.pending_mobility = (mitigation, mitigation_severity)
+            return
         for city in self.cities:
-            selection = self.select_random(city.density, city.network_keys)
-            selection_two = self.select_random(city.density/2, city.network_keys)
-            for node in selection:
-                for partner in selection_two:
-                    if mitigation == 0:
-                        if node != partner:
-                            city.network.add_edge(node, partner)
-                    else:
-                        rand = random.randint(0, mitigation_severity + 1)
-                        if rand == mitigation_severity:
-                            if node != partner:
-                                city.network.add_edge(node, partner)
-    def select_random(self, fraction, nodes):
-        # helper method
-        included = []
-        length = int(len(nodes)/fraction)
-        for i in range(length):
-            num = random.randint(0, len(nodes) - 1)
-            node = nodes[num]
-            if node in included:
-                numbers = range(0,num) + range(num + 1, len(nodes))
-                node = nodes[random.choice(numbers)]
-                included.append(node)
-        return list(set(included))
+            city.simulate_mobility(mitigation, mitigation_severity)
+    def snapshot(self):
+        # captures the whole simulation at the current day (the compartment
+        # state of every city, the day that keys the travel streams and the
+        # case history) so policy variants can branch from it instead of
+        # rerunning the days before it
+        if self.pool is not None:
+            raise ValueError("The cities are stepped on workers, snapshot before starting the pool")
+        return Snapshot(self.day, [city.fork() for city in self.cities], list(self.total_cases), self.pending_mobility)
+    def branch(self, snapshot, workers=0):
+        # new network continuing from a snapshot. it shares the flight network,
+        # the flows and the graphs and contact layers of the cities with this
+        # network, and only copies the compartment state of the cities
+        branch = copy(self)
+        branch.cities = [city.fork() for city in snapshot.cities]
+        branch.network = nx.relabel_nodes(self.network, dict(zip(self.cities, branch.cities)))
+        branch.annotations = []
+        branch.geometries = []
+        branch.total_cases = list(snapshot.total_cases)
+        branch.pending_mobility = snapshot.pending_mobility
+        branch.day = snapshot.day
+        branch.pool = CityPool(branch.cities, workers) if workers > 0 else None
+        return branch
+    def run_branches(self, snapshot, timelines, steps, workers=0):
+        # runs every policy timeline for steps more days from the snapshot and
+        # returns the branches. the timelines are compiled over absolute days
+        branches = []
+        for timeline in timelines:
+            branch = self.branch(snapshot, workers)
+            policy = timeline.compile(snapshot.day + steps, branch.cities)
+            for day in range(snapshot.day, snapshot.day + steps):
+                branch.policy_step(policy, day)
+            branch.close()
+            branches.append(branch)
+        return branches
+    def checkpoint(self):
+        # simulation state of the network and its cities as (metadata, arrays),
+        # see Checkpoint.py
+        states = self.pool.checkpoint() if self.pool is not None else [city.checkpoint() for city in self.cities]
+        meta = {"day": self.day, "total_cases": [int(cases) for cases in self.total_cases],
+                "pending_mobility": self.pending_mobility, "cities": [], "streams": self.streams.get_state()}
+        arrays = {}
+        for i, (city_meta, city_arrays) in enumerate(states):
+            meta["cities"].append(city_meta)
+            arrays.update({"city" + str(i) + "." + name: array for name, array in city_arrays.items()})
+        return meta, arrays
+    def restore(self, meta, arrays):
+        # continues from a checkpoint of a network with the same cities, in the same order
+        if len(meta["cities"]) != len(self.cities):
+            raise ValueError("The checkpoint was made on a network of " + str(len(meta["cities"])) + " cities")
+        self.streams.set_state(meta["streams"])
+        states = []
+        for i, city_meta in enumerate(meta["cities"]):
+            prefix = "city" + str(i) + "."
+            states.append((city_meta, {name[len(prefix):]: array for name, array in arrays.items() if name.startswith(prefix)}))
+        if self.pool is not None:
+            self.pool.restore(states)
+        else:
+            for city, state in zip(self.cities, states):
+                city.restore(*state)
+        self.day = meta["day"]
+        self.total_cases = list(meta["total_cases"])
+        self.pending_mobility = tuple(meta["pending_mobility"]) if meta["pending_mobility"] is not None else None
+    def close(self):
+        # stops the worker processes, if any
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
     # PLOTTING FUNCTIONS
     def plot_cities(self):
@@ -193,7 +308,7 @@ class OutbreakNetwork:
         self.annotations.append(total_cases)
         self.annotations.append(total_num)
         self.annotations.append(current_day)
-        TOTAL_CASES.append(self.count_infected())
+        self.total_cases.append(self.count_infected())
     def plot_city_infections(self, ax):
         # helper method for plotting city data
         for city in self.cities:
@@ -265,16 +380,19 @@ def initialze_plot():
 # MAIN METHOD
 def main():
     cities = []
-    US = OutbreakNetwork("FlightCapacities.txt", cities)
+    # street networks from OSM extracts or GraphML files named after the cities in streets/
+    street_networks = StreetNetworks("streets/cache", "streets", density=10)
+    US = OutbreakNetwork("FlightCapacities.txt", cities, street_networks=street_networks)
     # plots the network against a backdrop of the United States
     fig, ax = initialze_plot()
     US.plot_edges()
     US.plot_cities()
     US.simulate_travel(100, 60, fig, ax)
     figure_2 = plt.figure()
-    plt.plot(TOTAL_CASES)
+    plt.plot(US.total_cases)
     plt.ylabel('# of ')
     plt.savefig("Total Cases.png")
     plt.show()
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import multiprocessing as mp
+
+class CityPool:
+    """Steps the cities of an OutbreakNetwork on a pool of worker processes.
+    Every worker is handed its share of the cities once, when the pool starts,
+    and keeps them for the whole run, so the city graphs are never re-pickled.
+    Each day the main process sends every worker one small message with the
+    mobility settings, the number of travel importations per city and the
+    step settings of every city, and waits for all workers to answer with the
+    counters of their cities before the next day starts. When every city has its
+    adjacency in an AdjacencyStore the workers are spawned rather than forked,
+    so each one only receives its own cities, without their networkx graphs,
+    and maps the shared adjacency files."""
+    def __init__(self, cities, workers):
+        self.cities = cities
+        self.positions = {city: i for i, city in enumerate(cities)}
+        self.connections = []
+        self.processes = []
+        context = mp.get_context("spawn") if all(city.shared for city in cities) else mp.get_context()
+        for worker in range(workers):
+            positions = list(range(worker, len(cities), workers))
+            parent, child = context.Pipe()
+            process = context.Process(target=run_worker, args=(child, {i: cities[i] for i in positions}), daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    def step(self, mobility, imports, settings):
+        """Run one day on every worker and copy the resulting counters onto the
+        cities of the main process. mobility is None or the (mitigation, severity)
+        arguments of City.simulate_mobility, imports maps cities to the number
+        of infected travellers they receive and settings holds the arguments of
+        City.run_day for every city in order"""
+        imports = {self.positions[city]: count for city, count in imports.items() if count > 0}
+        for connection in self.connections:
+            connection.send(("day", mobility, imports, settings))
+        for connection in self.connections: # barrier: every worker finishes the day
+            for i, counters in connection.recv().items():
+                city = self.cities[i]
+                city.number_infected, city.number_exposed, city.number_removed = counters
+
+    def checkpoint(self):
+        """Checkpoint (metadata, arrays) of every city, in order, collected from the workers"""
+        states = {}
+        for connection in self.connections:
+            connection.send(("checkpoint",))
+        for connection in self.connections:
+            states.update(connection.recv())
+        return [states[i] for i in range(len(self.cities))]
+
+    def restore(self, states):
+        """Restore every city on the workers from its checkpoint (metadata, arrays)"""
+        for worker, connection in enumerate(self.connections):
+            connection.send(("restore", {i: states[i] for i in range(worker, len(self.cities), len(self.connections))}))
+        errors = []
+        for connection in self.connections:
+            reply = connection.recv()
+            if isinstance(reply, Exception):
+                errors.append(reply)
+                continue
+            for i, counters in reply.items():
+                city = self.cities[i]
+                city.number_infected, city.number_exposed, city.number_removed = counters
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        """Stop the worker processes"""
+        for connection in self.connections:
+            connection.send(("close",))
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+def run_worker(connection, cities):
+    # loop run by each worker process on the cities it owns, until it is closed.
+    # the cities draw from their own day streams, so no reseeding is needed
+    while True:
+        message = connection.recv()
+        if message[0] == "close":
+            break
+        if message[0] == "checkpoint":
+            connection.send({i: city.checkpoint() for i, city in cities.items()})
+            continue
+        if message[0] == "restore":
+            try:
+                for i, state in message[1].items():
+                    cities[i].restore(*state)
+            except ValueError as error: # checkpoint of other graphs, the worker keeps running
+                connection.send(error)
+                continue
+            connection.send({i: (city.number_infected, city.number_exposed, city.number_removed)
+                             for i, city in cities.items()})
+            continue
+        command, mobility, imports, settings = message
+        counters = {}
+        for i, city in cities.items():
+            if mobility is not None:
+                city.simulate_mobility(*mobility)
+            city.introduce_infected_nodes(imports.get(i, 0))
+            city.run_day(*settings[i])
+            counters[i] = (city.number_infected, city.number_exposed, city.number_removed)
+        connection.send(counters)
+    connection.close()
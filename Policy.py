@@ -0,0 +1,73 @@
+import numpy as np
+from City import SEIR_PARAMETERS, SD_SEIR_PARAMETERS
+
+class Intervention:
+    """A mitigation measure active from start_day up to (not including) end_day
+    in the named cities, or in every city when cities is None. beta_multiplier
+    scales the transmission of every contact, contact_rate is the fraction of
+    contacts kept by social distancing, travel_cap is the fraction of the
+    flights in and out of the city still flying (a route flies the smaller
+    cap of its two cities) and mobility_scale scales the transmission of the
+    daily mobility contacts."""
+    def __init__(self, start_day, end_day=None, cities=None, beta_multiplier=1.0,
+                 contact_rate=1.0, travel_cap=1.0, mobility_scale=1.0):
+        self.start_day = start_day
+        self.end_day = end_day
+        self.cities = cities
+        self.beta_multiplier = beta_multiplier
+        self.contact_rate = contact_rate
+        self.travel_cap = travel_cap
+        self.mobility_scale = mobility_scale
+
+class PolicyTimeline:
+    """Ordered list of interventions, compiled up front into per-day, per-city
+    parameter arrays that the simulation indexes every day. Where interventions
+    overlap their multipliers, contact rates and mobility scales multiply and the
+    strictest travel cap applies."""
+    def __init__(self, interventions=None):
+        self.interventions = list(interventions) if interventions is not None else []
+
+    def add(self, intervention):
+        """Add an intervention to the timeline"""
+        self.interventions.append(intervention)
+        return self
+
+    def compile(self, days, cities):
+        """Compile the timeline for a run of the given number of days over the given cities"""
+        shape = (days, len(cities))
+        policy = CompiledPolicy(np.ones(shape), np.ones(shape), np.ones(shape), np.ones(shape), np.zeros(shape, dtype=bool))
+        for intervention in self.interventions:
+            end_day = days if intervention.end_day is None else min(intervention.end_day, days)
+            columns = [i for i, city in enumerate(cities)
+                       if intervention.cities is None or city.city_name in intervention.cities]
+            cells = np.ix_(np.arange(intervention.start_day, end_day), columns)
+            policy.beta_multiplier[cells] *= intervention.beta_multiplier
+            policy.contact_rate[cells] *= intervention.contact_rate
+            policy.travel_cap[cells] = np.minimum(policy.travel_cap[cells], intervention.travel_cap)
+            policy.mobility_scale[cells] *= intervention.mobility_scale
+            policy.active[cells] = True
+        policy.find_periods()
+        return policy
+
+class CompiledPolicy:
+    """Per-day, per-city parameter arrays (indexed [day, city]) produced by PolicyTimeline.compile"""
+    def __init__(self, beta_multiplier, contact_rate, travel_cap, mobility_scale, active):
+        self.beta_multiplier = beta_multiplier
+        self.contact_rate = contact_rate
+        self.travel_cap = travel_cap
+        self.mobility_scale = mobility_scale
+        self.active = active
+
+    def find_periods(self):
+        """Mark the days on which a new policy period starts in each city"""
+        parameters = np.stack((self.beta_multiplier, self.contact_rate, self.travel_cap, self.mobility_scale))
+        self.new_period = np.ones(self.active.shape, dtype=bool)
+        self.new_period[1:] = (parameters[:, 1:] != parameters[:, :-1]).any(axis=0)
+
+    def step_parameters(self, day, city):
+        """Arguments of City.step for a city on a given day. Mitigated days use the
+        infectious period range of the social distancing model"""
+        multiplier = self.beta_multiplier[day, city]
+        contact_rate = self.contact_rate[day, city]
+        onset = SD_SEIR_PARAMETERS[2:] if multiplier < 1.0 or contact_rate < 1.0 else SEIR_PARAMETERS[2:]
+        return (float(multiplier), float(contact_rate)) + onset
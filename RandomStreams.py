@@ -0,0 +1,137 @@
+import zlib
+import numpy as np
+
+# Purposes of the random streams, part of the key of every stream
+GRAPH = 0 # rewiring of a city graph
+SETUP = 1 # initial infections of a city
+DAY = 2 # one day of a city: mobility, importations, thinning and the step
+TRAVEL = 3 # one day of travel between the cities
+ENSEMBLE = 4 # initial infections of one replica of an Ensemble
+IMPORTS = 5 # infected travellers and other introductions into a city on one day
+TRANSMISSION = 6 # per-contact draws of a city on one day in common random numbers mode, or of an Ensemble replica
+PROGRESSION = 7 # per-node draws of a city on one day in common random numbers mode, or of an Ensemble replica
+THINNING = 8 # contacts an Ensemble replica keeps in a policy period of social distancing
+
+BLOCK = 1 << 14 # keys hashed at once by keyed_uniforms
+
+class RandomStreams:
+    """Independent random streams derived from one master seed. Every stream is
+    a Philox generator seeded by a SeedSequence whose spawn key is (run,
+    replica, purpose, city, day), so what a city draws on a given day depends
+    only on the master seed and that key, and not on which process steps the
+    city or in which order the cities are stepped. Cities are identified by
+    their position in the OutbreakNetwork.
+
+    With common, the streams drive paired runs of different scenarios (common
+    random numbers): the draws of every contact and every progressing node are
+    counter-based uniforms keyed by the contact or node, so two scenarios run
+    from the same streams share them even after their epidemics diverge."""
+    def __init__(self, seed=None, run=0, replica=0, common=False):
+        self.entropy = np.random.SeedSequence(seed).entropy
+        self.seeded = seed is not None # whether other runs can draw the same streams again
+        self.run = run
+        self.replica = replica
+        self.common = common
+
+    def generator(self, purpose, city=0, day=0):
+        """Generator of the stream with the given purpose, city index and day"""
+        key = (self.run, self.replica, purpose, city, day)
+        return np.random.Generator(np.random.Philox(np.random.SeedSequence(self.entropy, spawn_key=key)))
+
+    def for_run(self, run):
+        """Streams of another run from the same master seed"""
+        return self.derived(run, self.replica)
+
+    def for_replica(self, replica):
+        """Streams of another replica of the same run"""
+        return self.derived(self.run, replica)
+
+    def derived(self, run, replica):
+        streams = RandomStreams(self.entropy, run, replica, self.common)
+        streams.seeded = self.seeded
+        return streams
+
+    def get_state(self):
+        """Master seed and key of the streams, for checkpoints"""
+        return {"entropy": str(self.entropy), "run": self.run, "replica": self.replica, "common": self.common}
+
+    def set_state(self, state):
+        """Switch to the master seed and key of a state made by get_state"""
+        self.entropy = int(state["entropy"])
+        self.run = state["run"]
+        self.replica = state["replica"]
+        self.common = state["common"]
+
+    def city(self, index, day):
+        """Generator of a city for one day"""
+        return self.generator(DAY, index, day)
+
+    def travel(self, day):
+        """Generator of the travel between the cities for one day"""
+        return self.generator(TRAVEL, 0, day)
+
+    def uniforms(self, purpose, city, day, keys, salt=0):
+        """Uniform draws in [0, 1) that only depend on the stream key, the salt
+        and each of the given non-negative integer keys"""
+        return keyed_uniforms(self.base(purpose, city, day), keys, salt)
+
+    def base(self, purpose, city, day):
+        """Starting point of the counter-based draws of uniforms on a stream"""
+        key = (self.run, self.replica, purpose, city, day)
+        return np.random.SeedSequence(self.entropy, spawn_key=key).generate_state(1, np.uint64)[0]
+
+def keyed_uniforms(base, keys, salt=0):
+    # the draws of uniforms from the base of a stream, or from an array holding
+    # the base of the stream of every key. The keys are hashed in place in
+    # blocks small enough to stay in cache
+    keys = np.asarray(keys, dtype=np.uint64)
+    draws = np.empty(len(keys))
+    for start in range(0, len(keys), BLOCK):
+        bases = base[start:start + BLOCK] if np.ndim(base) else base
+        mixed = keys[start:start + BLOCK] * np.uint64(0x9E3779B97F4A7C15)
+        mixed += bases
+        mixed += np.uint64(salt)
+        mixed = mix(mixed)
+        mixed ^= bases
+        mixed = mix(mixed)
+        mixed >>= np.uint64(11)
+        np.multiply(mixed, 1.0 / (1 << 53), out=draws[start:start + BLOCK])
+    return draws
+
+def generator_state(rng):
+    # state of a generator as plain lists and numbers, for checkpoints
+    return {key: encode_value(value) for key, value in rng.bit_generator.state.items()}
+
+def restore_generator(state):
+    # generator continuing from a state made by generator_state
+    state = {key: decode_value(value) for key, value in state.items()}
+    bit_generator = getattr(np.random, state["bit_generator"])()
+    bit_generator.state = state
+    return np.random.Generator(bit_generator)
+
+def encode_value(value):
+    if isinstance(value, dict):
+        return {key: encode_value(item) for key, item in value.items()}
+    if isinstance(value, np.ndarray):
+        return {"array": [int(item) for item in value], "dtype": str(value.dtype)}
+    return int(value) if isinstance(value, np.integer) else value
+
+def decode_value(value):
+    if isinstance(value, dict) and "array" in value:
+        return np.array(value["array"], dtype=value["dtype"])
+    if isinstance(value, dict):
+        return {key: decode_value(item) for key, item in value.items()}
+    return value
+
+def name_key(name):
+    # stable integer key of a name (e.g. of a contact layer), the same in every run and process
+    return zlib.crc32(name.encode())
+
+def mix(x):
+    # splitmix64 finalizer, bijective and well mixed, applied in place to an array of uint64
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return x
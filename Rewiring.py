@@ -0,0 +1,81 @@
+from itertools import chain
+import numpy as np
+
+# Degree preserving rewiring by double edge swaps, proposed and validated in
+# batches over arrays of edge endpoints instead of one swap per Python
+# iteration. A swap replaces the edges (u1, v1) and (u2, v2) by (u1, v2) and
+# (u2, v1), and is rejected when it would create a self-loop or an edge that
+# already exists. Self-loops and parallel edges of the input are never swapped.
+
+def rewire_graph(network, swaps, rng):
+    # rewires a networkx graph in place with swaps double edge swaps and
+    # returns the (removed, added) lists of the edges that changed
+    keys = list(network.nodes())
+    index = {node: i for i, node in enumerate(keys)}
+    edges = np.fromiter(map(index.__getitem__, chain.from_iterable(network.edges())), dtype=np.int64).reshape(-1, 2)
+    sources, targets = double_edge_swap(edges[:, 0], edges[:, 1], len(keys), swaps, rng)
+    before = edge_keys(edges[:, 0], edges[:, 1], len(keys))
+    after = edge_keys(sources, targets, len(keys))
+    # an edge swapped away and created again elsewhere did not change
+    changed = before != after
+    before, after = before[changed], after[changed]
+    removed = [(keys[key // len(keys)], keys[key % len(keys)]) for key in before[~np.isin(before, after)].tolist()]
+    added = [(keys[key // len(keys)], keys[key % len(keys)]) for key in after[~np.isin(after, before)].tolist()]
+    network.remove_edges_from(removed)
+    network.add_edges_from(added)
+    return removed, added
+
+def double_edge_swap(sources, targets, size, swaps, rng, max_tries=None):
+    # returns the endpoint arrays of the undirected edges (sources[i], targets[i])
+    # of a graph of size nodes after swaps successful swaps, or fewer if
+    # max_tries proposals (by default 10 per swap) are not enough
+    sources = sources.copy()
+    targets = targets.copy()
+    keys = edge_keys(sources, targets, size)
+    candidates = np.flatnonzero((sources != targets) & ~repeated(keys))
+    tries = max_tries if max_tries is not None else max(100, 10 * swaps)
+    done = 0
+    while done < swaps and tries > 0 and len(candidates) >= 2:
+        pairs = min(len(candidates) // 2, max(2 * (swaps - done), 16), tries)
+        tries -= pairs
+        chosen = rng.choice(candidates, 2 * pairs, replace=False)
+        first, second = chosen[:pairs], chosen[pairs:]
+        u1, v1 = sources[first], targets[first]
+        flip = rng.random(pairs) < 0.5 # both orientations of the second edge
+        u2 = np.where(flip, targets[second], sources[second])
+        v2 = np.where(flip, sources[second], targets[second])
+        new_first = edge_keys(u1, v2, size)
+        new_second = edge_keys(u2, v1, size)
+        existing = np.sort(keys)
+        valid = (u1 != u2) & (u1 != v2) & (v1 != u2) & (v1 != v2)
+        valid &= ~contains(existing, new_first) & ~contains(existing, new_second)
+        # two swaps of a batch must not create the same edge
+        proposed = np.flatnonzero(valid)
+        twice = repeated(np.concatenate((new_first[proposed], new_second[proposed])))
+        valid[proposed[twice[:len(proposed)] | twice[len(proposed):]]] = False
+        accepted = np.flatnonzero(valid)[:swaps - done]
+        targets[first[accepted]] = v2[accepted]
+        sources[second[accepted]] = u2[accepted]
+        targets[second[accepted]] = v1[accepted]
+        keys[first[accepted]] = new_first[accepted]
+        keys[second[accepted]] = new_second[accepted]
+        done += len(accepted)
+    return sources, targets
+
+def edge_keys(sources, targets, size):
+    # one integer per undirected edge, independent of its orientation
+    return np.minimum(sources, targets) * size + np.maximum(sources, targets)
+
+def repeated(keys):
+    # whether each key appears more than once in keys
+    order = np.argsort(keys, kind='stable')
+    same = keys[order[1:]] == keys[order[:-1]]
+    mask = np.zeros(len(keys), dtype=bool)
+    mask[order[1:][same]] = True
+    mask[order[:-1][same]] = True
+    return mask
+
+def contains(existing, keys):
+    # whether each key is in the sorted array existing
+    positions = np.minimum(np.searchsorted(existing, keys), len(existing) - 1)
+    return existing[positions] == keys
@@ -0,0 +1,24 @@
+import numpy as np
+
+# Random subset and pairing helpers shared by City and OutbreakNetwork. They
+# work on dense node indices and return NumPy arrays, so their cost is
+# proportional to the size of the result rather than to a Python scan of it.
+
+def select_random(count, size, rng):
+    # selects count distinct indices out of range(size) uniformly, capped at size
+    count = max(0, min(int(count), size))
+    return rng.choice(size, count, replace=False)
+
+def select_from(items, count, rng):
+    # selects count distinct entries of a list or array uniformly, capped at its length
+    return np.asarray(items)[select_random(count, len(items), rng)]
+
+def random_pairing(left, right, contacts, rng):
+    # pairs every index of left with contacts partners drawn uniformly from
+    # right and returns the two endpoint arrays, without self pairs
+    if len(left) == 0 or len(right) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    sources = np.repeat(np.asarray(left, dtype=np.int64), contacts)
+    targets = np.asarray(right, dtype=np.int64)[rng.integers(len(right), size=len(sources))]
+    distinct = sources != targets
+    return sources[distinct], targets[distinct]
@@ -0,0 +1,36 @@
+import numpy as np
+from RandomStreams import RandomStreams
+
+# Paired comparison of mitigation policies with common random numbers. Every
+# arm of a replica runs from the same streams, so the arms share their initial
+# infections, graph rewiring, mobility, per-contact transmission draws and
+# travel streams, and the differences between arms come from the policies
+# rather than from Monte Carlo noise.
+
+def compare_policies(build_network, timelines, days, replicas=1, seed=None):
+    # runs every PolicyTimeline for the given number of days on replicas pairs
+    # of networks. build_network(streams) returns a new OutbreakNetwork whose
+    # cities are built with those streams. returns the number of infected nodes
+    # of every city as an (arms, replicas, days, cities) array
+    master = RandomStreams(seed, common=True)
+    infected = []
+    for timeline in timelines:
+        arm = []
+        for replica in range(replicas):
+            network = build_network(master.for_replica(replica))
+            policy = timeline.compile(days, network.cities)
+            series = []
+            for day in range(days):
+                network.policy_step(policy, day)
+                series.append([city.number_infected for city in network.cities])
+            network.close()
+            arm.append(series)
+        infected.append(arm)
+    return np.array(infected)
+
+def paired_differences(infected, baseline=0):
+    # differences of every arm to the baseline arm within each replica, and
+    # their mean and standard error over the replicas
+    differences = infected - infected[baseline]
+    error = differences.std(axis=1, ddof=1) / np.sqrt(infected.shape[1]) if infected.shape[1] > 1 else None
+    return differences, differences.mean(axis=1), error
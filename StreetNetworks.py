@@ -0,0 +1,209 @@
+import bz2
+import gzip
+import hashlib
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+import networkx as nx
+import numpy as np
+from ArrayEngine import edges_to_csr
+from AdjacencyStore import share_array, open_array, write_entry
+from GraphCache import GraphCache
+from Rewiring import double_edge_swap, edge_keys
+
+FORMAT_VERSION = 1
+GRAPHML_SUFFIXES = (".graphml",)
+OSM_SUFFIXES = (".osm", ".osm.gz", ".osm.bz2", ".xml")
+
+class StreetGraph:
+    """Street network of a city in the compact form the simulator builds its
+    adjacency from: the node ids (dense index -> OSM node id) and the dense
+    endpoint arrays of its undirected edges, without self-loops or parallel
+    edges. City accepts it in place of a networkx graph and rewires the arrays
+    directly, so a city built from one never touches networkx."""
+    def __init__(self, keys, sources, targets):
+        self.keys = keys
+        self.sources = sources
+        self.targets = targets
+
+    def __getstate__(self):
+        # memory-mapped arrays travel to worker processes as their file paths
+        return {name: share_array(array) for name, array in self.__dict__.items()}
+
+    def __setstate__(self, state):
+        self.__dict__.update({name: open_array(value) for name, value in state.items()})
+
+    @staticmethod
+    def from_adjacency(keys, indptr, indices):
+        """StreetGraph of the undirected CSR adjacency (indptr, indices) over the given node ids"""
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        upper = rows < indices
+        return StreetGraph(keys, rows[upper], np.asarray(indices)[upper])
+
+    def number_of_nodes(self):
+        return len(self.keys)
+
+    def number_of_edges(self):
+        return len(self.sources)
+
+    def nodes(self):
+        """Node ids in dense index order"""
+        return self.keys.tolist()
+
+    def rewired(self, swaps, rng):
+        """Copy of the graph after swaps double edge swaps, see Rewiring.py"""
+        sources, targets = double_edge_swap(self.sources, self.targets, len(self.keys), swaps, rng)
+        return StreetGraph(self.keys, sources, targets)
+
+    def adjacency(self):
+        """CSR adjacency (indptr, indices) of the graph over the dense node indices"""
+        return edges_to_csr(len(self.keys), self.sources, self.targets)
+
+class StreetNetworks:
+    """Offline provider of the street networks of the cities. A network is
+    built from a local source file, an OSM XML extract (.osm, optionally .gz or
+    .bz2 compressed) or a GraphML file saved before (e.g. by osmnx.save_graphml),
+    converted once into a StreetGraph and cached in the directory by city name
+    and build parameters as .npy files, which later runs load memory-mapped.
+    A cached network is rebuilt only when its source file changes, and used
+    as it is when the source is absent. The files are given as a city name ->
+    path dict, or as a directory holding files named after the cities (e.g.
+    "Boston, Massachusetts, USA.osm"). The density (people per node) of a city
+    comes from densities, or density for every city that is not listed there.
+    The rewired graphs of the cities built from seeded streams are kept in a
+    GraphCache in the directory, up to the given number of rewirings (None for
+    no limit, 0 for no cache)."""
+    def __init__(self, directory, files=None, density=None, densities=None, simplify=True, highways=None,
+                 rewirings=16):
+        self.directory = directory
+        self.files = files if files is not None else {}
+        self.default_density = density
+        self.densities = dict(densities) if densities is not None else {}
+        self.simplify = simplify # keep only the intersections and dead ends of OSM extracts
+        self.highways = None if highways is None else sorted(highways) # highway tag values kept, None for all
+        os.makedirs(directory, exist_ok=True)
+        self.graph_cache = GraphCache(os.path.join(directory, "rewired"), rewirings) if rewirings != 0 else None
+
+    def key(self, name):
+        """Cache entry of a city for the build parameters of this provider"""
+        parameters = {"name": name, "simplify": self.simplify, "highways": self.highways, "version": FORMAT_VERSION}
+        return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+    def path(self, name, array):
+        return os.path.join(self.directory, self.key(name), array + ".npy")
+
+    def density(self, name):
+        """People per node of a city"""
+        density = self.densities.get(name, self.default_density)
+        if density is None:
+            raise ValueError("No density for " + name)
+        return density
+
+    def source(self, name):
+        """Path of the source file of a city, or None if it has none"""
+        if isinstance(self.files, dict):
+            return self.files.get(name)
+        for suffix in GRAPHML_SUFFIXES + OSM_SUFFIXES:
+            path = os.path.join(self.files, name + suffix)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def load(self, name):
+        """StreetGraph of a city, from the cache or converted from its source file"""
+        source = self.source(name)
+        meta = os.path.join(self.directory, self.key(name), "meta.json")
+        if os.path.exists(meta):
+            with open(meta) as file:
+                built_from = json.load(file)["source"]
+            if source is None or not os.path.exists(source) or built_from == stamp(source):
+                return self.cached(name)
+        if source is None or not os.path.exists(source):
+            raise ValueError("No cached street network and no source file for " + name)
+        if source.endswith(GRAPHML_SUFFIXES):
+            graph = from_networkx(read_graphml(source))
+        elif source.endswith(OSM_SUFFIXES):
+            graph = read_osm(source, self.simplify, self.highways)
+        else:
+            raise ValueError("Unknown street network format of " + source + ", expected OSM XML or GraphML")
+        return self.store(name, graph, stamp(source))
+
+    def save(self, name, network):
+        """Cache the street network of a city from a networkx graph, e.g. one
+        downloaded with osmnx, so that later runs load it offline"""
+        return self.store(name, from_networkx(network), None)
+
+    def store(self, name, graph, source):
+        """Write a cache entry to a temporary directory, move it into place and
+        return its memory-mapped StreetGraph"""
+        arrays = {array: getattr(graph, array) for array in ("keys", "sources", "targets")}
+        meta = {"name": name, "source": source, "nodes": graph.number_of_nodes(), "edges": graph.number_of_edges()}
+        write_entry(self.directory, self.key(name), arrays, meta, replace=True) # over a stale entry of a changed source
+        return self.cached(name)
+
+    def cached(self, name):
+        """Memory-mapped StreetGraph of the cache entry of a city"""
+        return StreetGraph(*(np.load(self.path(name, array), mmap_mode='r') for array in ("keys", "sources", "targets")))
+
+def stamp(path):
+    # size and modification time of a source file, to notice it changed
+    status = os.stat(path)
+    return [status.st_size, status.st_mtime_ns]
+
+def simple_edges(sources, targets, size):
+    # the undirected edges of the endpoint arrays without self-loops or
+    # parallel edges, as sorted (sources, targets) arrays with sources < targets
+    keys = np.unique(edge_keys(sources, targets, size)[sources != targets])
+    return keys // size, keys % size
+
+def from_networkx(network):
+    # StreetGraph of a networkx graph of any kind, directed edges made undirected
+    keys = list(network.nodes())
+    index = {node: i for i, node in enumerate(keys)}
+    edges = np.array([(index[u], index[v]) for u, v in network.edges()], dtype=np.int64).reshape(-1, 2)
+    sources, targets = simple_edges(edges[:, 0], edges[:, 1], len(keys))
+    return StreetGraph(np.array(keys), sources, targets)
+
+def read_graphml(path):
+    # networkx graph of a GraphML file, with integer node ids when they all are
+    try:
+        return nx.read_graphml(path, node_type=int)
+    except ValueError:
+        return nx.read_graphml(path)
+
+def read_osm(path, simplify=True, highways=None):
+    # StreetGraph of the ways with a highway tag (of the given values, or any)
+    # of an OSM XML extract. Simplified graphs keep only the ends of the ways
+    # and the nodes shared by ways, with an edge between consecutive kept nodes
+    # of a way, like the street networks of osmnx
+    opener = gzip.open if path.endswith(".gz") else bz2.open if path.endswith(".bz2") else open
+    refs = []
+    lengths = [] # number of nodes of every kept way
+    with opener(path, "rb") as file:
+        elements = ElementTree.iterparse(file, events=("start", "end"))
+        event, root = next(elements)
+        for event, element in elements:
+            if event != "end":
+                continue
+            if element.tag == "way":
+                highway = next((tag.get("v") for tag in element.iter("tag") if tag.get("k") == "highway"), None)
+                if highway is not None and (highways is None or highway in highways):
+                    nodes = [int(nd.get("ref")) for nd in element.iter("nd")]
+                    refs.extend(nodes)
+                    lengths.append(len(nodes))
+            if element.tag in ("node", "way", "relation"):
+                root.clear() # the root would otherwise keep every element read so far
+    refs = np.array(refs, dtype=np.int64)
+    ways = np.repeat(np.arange(len(lengths)), lengths) # way of every entry of refs
+    if simplify and len(refs):
+        first = np.ones(len(ways), dtype=bool)
+        first[1:] = ways[1:] != ways[:-1]
+        last = np.roll(first, -1)
+        nodes, inverse, counts = np.unique(refs, return_inverse=True, return_counts=True)
+        kept = first | last | (counts[inverse] > 1)
+        refs, ways = refs[kept], ways[kept]
+    same_way = ways[1:] == ways[:-1]
+    # only the nodes on an edge are kept, numbered in node id order
+    keys, inverse = np.unique(np.concatenate((refs[:-1][same_way], refs[1:][same_way])), return_inverse=True)
+    sources, targets = simple_edges(inverse[:same_way.sum()], inverse[same_way.sum():], len(keys))
+    return StreetGraph(keys, sources, targets)
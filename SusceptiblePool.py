@@ -0,0 +1,84 @@
+import numpy as np
+from Sampling import select_random
+
+class SusceptiblePool:
+    """Indexable set of the susceptible nodes of a city. The nodes are kept in
+    the first count entries of an array, and position maps every node to its
+    entry, so membership, removal (by swapping with the last susceptible node)
+    and uniform sampling are all O(1) per node at any prevalence."""
+    def __init__(self, size):
+        self.nodes = np.arange(size, dtype=np.int64)
+        self.position = np.arange(size, dtype=np.int64)
+        self.count = size
+
+    def reset(self):
+        """Make every node susceptible again, in the order of a new pool"""
+        self.nodes[:] = self.position[:] = np.arange(len(self.nodes))
+        self.count = len(self.nodes)
+
+    def copy(self):
+        """Independent copy of the pool"""
+        pool = SusceptiblePool.__new__(SusceptiblePool)
+        pool.nodes = self.nodes.copy()
+        pool.position = self.position.copy()
+        pool.count = self.count
+        return pool
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, node):
+        return self.position[node] < self.count
+
+    def remove(self, node):
+        """Remove a susceptible node by swapping it with the last susceptible node"""
+        position = self.position[node]
+        if position >= self.count:
+            return
+        last = self.nodes[self.count - 1]
+        self.nodes[position], self.nodes[self.count - 1] = last, node
+        self.position[last], self.position[node] = position, self.count - 1
+        self.count -= 1
+
+    def remove_many(self, nodes):
+        """Remove an array of distinct susceptible nodes at once"""
+        positions = self.position[nodes]
+        count = self.count - len(nodes)
+        # the holes left in the kept region are filled with the survivors of the tail
+        holes = positions[positions < count]
+        tail = np.ones(self.count - count, dtype=bool)
+        tail[positions[positions >= count] - count] = False
+        survivors = np.flatnonzero(tail) + count
+        self.nodes[holes] = self.nodes[survivors]
+        self.position[self.nodes[holes]] = holes
+        self.nodes[count:self.count] = nodes
+        self.position[nodes] = np.arange(count, self.count)
+        self.count = count
+
+    def add_many(self, nodes):
+        """Make an array of distinct nodes that are not in the pool susceptible again"""
+        positions = self.position[nodes]
+        count = self.count + len(nodes)
+        # the nodes left out of the grown region are swapped with the non-susceptible nodes inside it
+        outside = positions >= count
+        region = np.ones(count - self.count, dtype=bool)
+        region[positions[~outside] - self.count] = False
+        occupied = np.flatnonzero(region) + self.count
+        holes = positions[outside]
+        displaced = self.nodes[occupied]
+        self.nodes[holes] = displaced
+        self.position[displaced] = holes
+        self.nodes[occupied] = nodes[outside]
+        self.position[nodes[outside]] = occupied
+        self.count = count
+
+    def choice(self, rng):
+        """Draw one susceptible node uniformly without removing it, or None if there is none left"""
+        if self.count == 0:
+            return None
+        return int(self.nodes[rng.integers(self.count)])
+
+    def sample(self, count, rng):
+        """Draw count distinct susceptible nodes uniformly without removing them,
+        capped at the number of susceptible nodes left"""
+        return self.nodes[select_random(count, self.count, rng)]